@@ -0,0 +1,510 @@
+import gc
+import json
+import math
+import time
+import random
+import asyncio
+import logging
+import argparse
+import resource
+import tracemalloc
+from collections import Counter, defaultdict
+from typing import Dict, List, Any, Optional
+
+import aiohttp
+from aiohttp import web
+from telegram import Update
+from telegram.ext import Application
+
+import main
+from main import SearchResult
+
+# Representative Pixabay hits (shape taken from the /api/ and /api/videos/ responses)
+SAMPLE_PHOTO_HIT = {
+    'id': 195893,
+    'pageURL': 'https://pixabay.com/en/blossom-bloom-flower-195893/',
+    'type': 'photo',
+    'tags': 'blossom, bloom, flower',
+    'previewURL': 'https://cdn.pixabay.com/photo/2013/10/15/09/12/flower-195893_150.jpg',
+    'previewWidth': 150,
+    'previewHeight': 84,
+    'webformatURL': 'https://pixabay.com/get/35bbf209e13e39d2_640.jpg',
+    'webformatWidth': 640,
+    'webformatHeight': 360,
+    'largeImageURL': 'https://pixabay.com/get/ed6a99fd0a76647_1280.jpg',
+    'fullHDURL': 'https://pixabay.com/get/ed6a9369fd0a76647_1920.jpg',
+    'imageURL': 'https://pixabay.com/get/ed6a9364a9fd0a76647.jpg',
+    'imageWidth': 4000,
+    'imageHeight': 2250,
+    'imageSize': 4731420,
+    'views': 7671,
+    'downloads': 6439,
+    'likes': 5,
+    'comments': 2,
+    'user_id': 48777,
+    'user': 'Josch13',
+    'userImageURL': 'https://cdn.pixabay.com/user/2013/11/05/02-10-23-764_250x250.jpg',
+}
+
+SAMPLE_VIDEO_HIT = {
+    'id': 125,
+    'pageURL': 'https://pixabay.com/videos/id-125/',
+    'type': 'film',
+    'tags': 'flowers, yellow, blossom',
+    'duration': 12,
+    'videos': {
+        size: {
+            'url': f'https://player.vimeo.com/external/135736646.{size}.mp4?s=ed02d71c92',
+            'width': width,
+            'height': height,
+            'size': 6615235,
+            'thumbnail': f'https://i.vimeocdn.com/video/530332183_{width}x{height}.jpg',
+        }
+        for size, width, height in [('large', 1920, 1080), ('medium', 1280, 720),
+                                    ('small', 960, 540), ('tiny', 640, 360)]
+    },
+    'views': 4462,
+    'downloads': 1464,
+    'likes': 18,
+    'comments': 0,
+    'user_id': 1281706,
+    'user': 'Coverr-Free-Footage',
+    'userImageURL': 'https://cdn.pixabay.com/user/2015/10/16/09-28-45-303_250x250.png',
+}
+
+
+def load_hits(count: int) -> List[Dict[str, Any]]:
+    """Decode a synthetic Pixabay response so every hit owns its own strings, as in production"""
+    hits = []
+    for i in range(count):
+        hit = dict(SAMPLE_VIDEO_HIT if i % 4 == 3 else SAMPLE_PHOTO_HIT)
+        hit['id'] = i
+        hit['tags'] = f"{hit['tags']}, tag{i}"
+        hits.append(hit)
+    return json.loads(json.dumps({'total': count, 'totalHits': count, 'hits': hits}))['hits']
+
+
+def measure(build) -> int:
+    """Return the bytes still allocated by the object built by build()"""
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        kept = build()
+        gc.collect()
+        after = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    del kept
+    return after - before
+
+
+def bench_result_memory(count: int):
+    """Compare memory held by raw Pixabay hit dicts and by SearchResult records"""
+    raw_bytes = measure(lambda: load_hits(count))
+    compact_bytes = measure(lambda: [SearchResult.from_hit(hit) for hit in load_hits(count)])
+
+    print(f"Stored results: {count}")
+    print(f"  raw hit dicts:        {raw_bytes / 1024:10.1f} KiB ({raw_bytes / count:7.1f} B/result)")
+    print(f"  SearchResult records: {compact_bytes / 1024:10.1f} KiB ({compact_bytes / count:7.1f} B/result)")
+    print(f"  saving:               {1 - compact_bytes / raw_bytes:10.1%}")
+
+
+BENCH_TOKEN = '123456:BENCH'
+BENCH_CHANNEL = '@bench_channel'
+SEARCH_TYPES = ['all', 'photo', 'video']
+
+
+class FakeService:
+    """Local HTTP stand-in with injected latency and errors"""
+
+    def __init__(self, latency: float, jitter: float, error_rate: float):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.requests: Counter = Counter()
+        self.errors = 0
+        self.runner: Optional[web.AppRunner] = None
+
+    async def simulate(self, name: str) -> bool:
+        """Count a request, wait the configured latency and return True if it should fail"""
+        self.requests[name] += 1
+        if self.latency or self.jitter:
+            await asyncio.sleep(max(0.0, self.latency + random.uniform(-self.jitter, self.jitter)))
+        if random.random() < self.error_rate:
+            self.errors += 1
+            return True
+        return False
+
+    def routes(self) -> List[web.RouteDef]:
+        raise NotImplementedError
+
+    async def start(self) -> str:
+        """Serve on a free local port and return the base URL"""
+        app = web.Application()
+        app.add_routes(self.routes())
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        host, port = self.runner.addresses[0][:2]
+        return f"http://{host}:{port}"
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+
+
+class FakePixabay(FakeService):
+    """Pixabay stand-in serving /api/, /api/videos/ and the media files they link to"""
+
+    def __init__(self, latency: float, jitter: float, error_rate: float, total_hits: int,
+                 padding: int, media_bytes: int):
+        super().__init__(latency, jitter, error_rate)
+        self.total_hits = total_hits
+        self.padding = 'x' * padding
+        self.media = b'\0' * media_bytes
+
+    def routes(self) -> List[web.RouteDef]:
+        return [
+            web.get('/api/', self.search),
+            web.get('/api/videos/', self.search),
+            web.get('/media/{path:.*}', self.media_file),
+        ]
+
+    def build_hit(self, hit_id: int, video: bool, base: str) -> Dict[str, Any]:
+        template = SAMPLE_VIDEO_HIT if video else SAMPLE_PHOTO_HIT
+        hit = json.loads(json.dumps(template).replace('https://', f"{base}/media/https_"))
+        hit['id'] = hit_id
+        hit['tags'] = f"{hit['tags']}, tag{hit_id}"
+        if self.padding:
+            hit['padding'] = self.padding
+        return hit
+
+    async def search(self, request: web.Request) -> web.Response:
+        endpoint = request.path
+        if await self.simulate(endpoint):
+            return web.json_response({'error': 'injected'}, status=500)
+        
+        page = int(request.query.get('page', '1'))
+        per_page = int(request.query.get('per_page', '20'))
+        video = endpoint.endswith('/videos/')
+        base = f"{request.scheme}://{request.host}"
+        first = (page - 1) * per_page
+        hits = [self.build_hit(hit_id, video, base)
+                for hit_id in range(first, min(first + per_page, self.total_hits))]
+        headers = {'X-RateLimit-Limit': '1000000', 'X-RateLimit-Remaining': '999999', 'X-RateLimit-Reset': '60'}
+        return web.json_response({'total': self.total_hits, 'totalHits': self.total_hits, 'hits': hits},
+                                 headers=headers)
+
+    async def media_file(self, request: web.Request) -> web.Response:
+        if await self.simulate('media'):
+            return web.Response(status=500)
+        return web.Response(body=self.media, content_type='application/octet-stream')
+
+
+class FakeTelegram(FakeService):
+    """Telegram Bot API stand-in answering every method the bot calls"""
+
+    BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot'}
+
+    def __init__(self, latency: float, jitter: float, error_rate: float):
+        super().__init__(latency, jitter, error_rate)
+        self.message_ids = 0
+        self.file_ids = 0
+        self.webhook: Dict[str, Any] = {'url': ''}
+
+    def routes(self) -> List[web.RouteDef]:
+        return [web.post('/bot{token}/{method}', self.call)]
+
+    def message(self, chat_id: Any, **media) -> Dict[str, Any]:
+        self.message_ids += 1
+        return {'message_id': self.message_ids, 'date': int(time.time()), 'from': self.BOT_USER,
+                'chat': {'id': int(chat_id or 0), 'type': 'private'}, **media}
+
+    def media(self, kind: Optional[str]) -> Dict[str, Any]:
+        self.file_ids += 1
+        file = {'file_id': f"{kind}-{self.file_ids}", 'file_unique_id': f"u{self.file_ids}"}
+        if kind == 'photo':
+            return {'photo': [{**file, 'width': 640, 'height': 360}]}
+        if kind == 'video':
+            return {'video': {**file, 'width': 960, 'height': 540, 'duration': 12}}
+        if kind == 'audio':
+            return {'audio': {**file, 'duration': 120}}
+        return {'text': 'ok'}
+
+    async def call(self, request: web.Request) -> web.Response:
+        method = request.match_info['method']
+        if await self.simulate(method):
+            return web.json_response({'ok': False, 'error_code': 500, 'description': 'Injected error'}, status=500)
+        
+        data = await request.post()
+        chat_id = data.get('chat_id')
+        if method == 'getMe':
+            result = {**self.BOT_USER, 'can_join_groups': True, 'can_read_all_group_messages': False,
+                      'supports_inline_queries': True}
+        elif method == 'getChatMember':
+            result = {'status': 'member', 'user': {'id': int(data['user_id']), 'is_bot': False, 'first_name': 'U'}}
+        elif method in ('sendPhoto', 'sendVideo', 'sendAudio'):
+            result = self.message(chat_id, **self.media(method[4:].lower()))
+        elif method == 'editMessageMedia':
+            result = self.message(chat_id, **self.media(json.loads(data['media'])['type']))
+        elif method == 'sendMediaGroup':
+            result = [self.message(chat_id, **self.media(item['type'])) for item in json.loads(data['media'])]
+        elif method in ('sendMessage', 'editMessageText'):
+            result = self.message(chat_id, text=data.get('text', ''))
+        elif method == 'getWebhookInfo':
+            result = {**self.webhook, 'has_custom_certificate': False, 'pending_update_count': 0}
+        elif method == 'setWebhook':
+            self.webhook = {'url': data['url'], 'allowed_updates': json.loads(data.get('allowed_updates', '[]'))}
+            result = True
+        else:
+            result = True
+        return web.json_response({'ok': True, 'result': result})
+
+
+class UpdateFactory:
+    """Builds synthetic Telegram updates for simulated users"""
+
+    def __init__(self, application: Application):
+        self.bot = application.bot
+        self.update_ids = 0
+
+    def _next_id(self) -> int:
+        self.update_ids += 1
+        return self.update_ids
+
+    @staticmethod
+    def _user(user_id: int) -> Dict[str, Any]:
+        return {'id': user_id, 'is_bot': False, 'first_name': f"User{user_id}", 'username': f"user{user_id}"}
+
+    def message(self, user_id: int, text: str) -> Update:
+        message = {'message_id': self._next_id(), 'date': int(time.time()), 'text': text,
+                   'from': self._user(user_id), 'chat': {'id': user_id, 'type': 'private'}}
+        if text.startswith('/'):
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+        return Update.de_json({'update_id': self._next_id(), 'message': message}, self.bot)
+
+    def callback(self, user_id: int, data: str) -> Update:
+        message = {'message_id': self._next_id(), 'date': int(time.time()), 'text': 'menu',
+                   'from': FakeTelegram.BOT_USER, 'chat': {'id': user_id, 'type': 'private'}}
+        query = {'id': str(self._next_id()), 'from': self._user(user_id), 'chat_instance': str(user_id),
+                 'data': data, 'message': message}
+        return Update.de_json({'update_id': self._next_id(), 'callback_query': query}, self.bot)
+
+
+class TrackedUpdateProcessor(main.UserOrderedUpdateProcessor):
+    """The bot's update processor, resolving a future once each expected update is handled or dropped"""
+
+    def __init__(self):
+        super().__init__()
+        self.handled: Dict[int, asyncio.Future] = {}
+
+    def expect(self, update_id: int) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        self.handled[update_id] = future
+        return future
+
+    async def process_update(self, update: object, coroutine):
+        try:
+            await super().process_update(update, coroutine)
+        finally:
+            future = self.handled.pop(getattr(update, 'update_id', None), None)
+            if future is not None and not future.done():
+                future.set_result(None)
+
+
+class WebhookClient:
+    """Delivers updates through the bot's webhook endpoint the way Telegram does, redelivering on 429"""
+
+    def __init__(self, application: Application, processor: TrackedUpdateProcessor):
+        self.application = application
+        self.processor = processor
+        self.rejected = 0
+        self.url = ''
+        self.runner: Optional[web.AppRunner] = None
+        self.session: Optional[aiohttp.ClientSession] = None
+
+    async def start(self):
+        self.runner = web.AppRunner(main.create_web_app(self.application), access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        host, port = self.runner.addresses[0][:2]
+        self.url = f"http://{host}:{port}/{main.BOT_TOKEN}"
+        self.session = aiohttp.ClientSession()
+
+    async def stop(self):
+        if self.session is not None:
+            await self.session.close()
+        if self.runner is not None:
+            await self.runner.cleanup()
+
+    async def send(self, update: Update):
+        """Post an update and wait until the bot has handled it"""
+        handled = self.processor.expect(update.update_id)
+        payload = update.to_dict()
+        while True:
+            async with self.session.post(self.url, json=payload) as response:
+                if response.status != 429:
+                    response.raise_for_status()
+                    break
+                self.rejected += 1
+                retry_after = float(response.headers.get('Retry-After', main.WEBHOOK_RETRY_AFTER))
+            await asyncio.sleep(retry_after)
+        await handled
+
+
+def percentile(ordered: List[float], fraction: float) -> float:
+    """Return the nearest-rank percentile of an ascending list"""
+    return ordered[max(0, math.ceil(len(ordered) * fraction) - 1)]
+
+
+async def simulate_user(client: WebhookClient, bot: 'main.PixabayBot', factory: UpdateFactory, user_id: int,
+                        query: str, search_type: str, steps: int, think_time: float,
+                        latencies: Dict[str, List[float]], gallery: bool = False):
+    """Drive one user through /start, subscription check, a search and paging (per result or per album)"""
+    async def send(action: str, update: Update):
+        started = time.perf_counter()
+        await client.send(update)
+        # Result navigation is debounced; the edit lands when the render task finishes
+        task = bot.move_tasks.get(user_id)
+        if task:
+            await asyncio.wait({task})
+        latencies[action].append(time.perf_counter() - started)
+        if think_time:
+            await asyncio.sleep(random.uniform(0, 2 * think_time))
+    
+    await send('start', factory.message(user_id, '/start'))
+    await send('verify', factory.callback(user_id, 'verify_subscription'))
+    await send('search_type', factory.callback(user_id, f"search_type_{search_type}"))
+    if gallery:
+        await send('gallery', factory.callback(user_id, 'toggle_gallery'))
+    await send('search_prompt', factory.callback(user_id, 'search_with_type'))
+    await send('search', factory.message(user_id, query))
+    step = 'album' if gallery else 'result'
+    for _ in range(steps):
+        await send('next', factory.callback(user_id, f"next_{step}"))
+    for _ in range(steps // 2):
+        await send('prev', factory.callback(user_id, f"prev_{step}"))
+
+
+async def run_broadcast(client: WebhookClient, bot: 'main.PixabayBot', factory: UpdateFactory) -> Dict[str, Any]:
+    """Let the admin broadcast to every simulated user and wait for the job to finish"""
+    admin_id = main.ADMIN_ID
+    await client.send(factory.message(admin_id, '/start'))
+    await client.send(factory.callback(admin_id, 'admin_broadcast'))
+    started = time.perf_counter()
+    await client.send(factory.message(admin_id, 'benchmark broadcast'))
+    while bot.broadcasts.is_running():
+        await asyncio.sleep(0.05)
+    job = bot.broadcasts.job or {}
+    return {'elapsed': time.perf_counter() - started, 'sent': job.get('sent', 0), 'failed': job.get('failed', 0)}
+
+
+async def bench_load(args: argparse.Namespace):
+    """Run synthetic users against the real handlers with local Pixabay and Telegram stand-ins"""
+    random.seed(args.seed)
+    pixabay = FakePixabay(args.pixabay_latency / 1000, args.pixabay_jitter / 1000, args.pixabay_errors,
+                          args.total_hits, args.padding, args.media_bytes)
+    telegram = FakeTelegram(args.telegram_latency / 1000, args.telegram_jitter / 1000, args.telegram_errors)
+    pixabay_url = await pixabay.start()
+    telegram_url = await telegram.start()
+    
+    bot = main.PixabayBot()
+    bot.pixabay_base_url = f"{pixabay_url}/api/"
+    main.force_channels[:] = [f"{BENCH_CHANNEL}{i}" for i in range(args.channels)]
+    # The production Application: per-user ordered processing, bounded update queue, instrumented requests
+    processor = TrackedUpdateProcessor()
+    application = main.build_application(bot, BENCH_TOKEN, f"{telegram_url}/bot", processor)
+    await application.initialize()
+    await application.post_init(application)
+    await application.start()
+    client = WebhookClient(application, processor)
+    await client.start()
+    
+    factory = UpdateFactory(application)
+    queries = [f"query{i}" for i in range(args.queries)]
+    latencies: Dict[str, List[float]] = defaultdict(list)
+    semaphore = asyncio.Semaphore(args.concurrency)
+    
+    async def user_session(user_id: int):
+        async with semaphore:
+            await simulate_user(client, bot, factory, user_id, random.choice(queries),
+                                SEARCH_TYPES[user_id % len(SEARCH_TYPES)], args.steps, args.think_time / 1000,
+                                latencies, args.gallery)
+    
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    started = time.perf_counter()
+    try:
+        await asyncio.gather(*[user_session(100000 + i) for i in range(args.users)])
+        elapsed = time.perf_counter() - started
+        broadcast = await run_broadcast(client, bot, factory) if args.broadcast else None
+    finally:
+        for task in list(bot.prefetch_tasks.values()) + list(bot.page_loads.values()):
+            task.cancel()
+        await client.stop()
+        await application.stop()
+        await application.post_shutdown(application)
+        await application.shutdown()
+        await pixabay.stop()
+        await telegram.stop()
+    rss_peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    
+    updates = sum(len(samples) for samples in latencies.values())
+    print(f"Load test: {args.users} users, {updates} updates in {elapsed:.2f} s ({updates / elapsed:.1f} updates/s)")
+    print(f"  {'action':<14}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for action, samples in list(latencies.items()) + [('all', [s for v in latencies.values() for s in v])]:
+        ordered = sorted(samples)
+        print(f"  {action:<14}{len(ordered):>8}" + ''.join(
+            f"{value * 1000:>10.1f}" for value in
+            (percentile(ordered, 0.5), percentile(ordered, 0.95), percentile(ordered, 0.99), ordered[-1])))
+    cache_stats = bot.search_cache.stats()
+    print(f"  Pixabay calls: {dict(pixabay.requests)} (injected errors: {pixabay.errors})")
+    print(f"  Telegram calls: {sum(telegram.requests.values())} (injected errors: {telegram.errors})")
+    print(f"  webhook 429 rejections: {client.rejected}, updates dropped by the processor: {processor.dropped}")
+    print(f"  search cache hit ratio: {cache_stats['hit_ratio']:.1%}, file_id hit ratio: "
+          f"{bot.file_ids.stats()['hit_ratio']:.1%}")
+    if broadcast:
+        print(f"  broadcast: {broadcast['sent']} sent, {broadcast['failed']} failed in {broadcast['elapsed']:.2f} s "
+              f"({broadcast['sent'] / broadcast['elapsed']:.1f} msg/s)")
+    print(f"  peak RSS: {rss_peak / 1024:.1f} MiB (+{(rss_peak - rss_before) / 1024:.1f} MiB during the run)")
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Pixabay bot benchmarks")
+    parser.add_argument('suite', nargs='?', choices=['memory', 'load'], default='memory',
+                        help="memory: SearchResult footprint; load: offline load test with local stand-ins")
+    parser.add_argument('--results', type=int, default=10000, help="number of stored results to measure")
+    load = parser.add_argument_group('load test')
+    load.add_argument('--users', type=int, default=200, help="simulated users")
+    load.add_argument('--concurrency', type=int, default=50, help="users active at the same time")
+    load.add_argument('--steps', type=int, default=10, help="'next' taps per user (half as many 'prev')")
+    load.add_argument('--gallery', action='store_true', help="browse in gallery mode (albums instead of single results)")
+    load.add_argument('--queries', type=int, default=50, help="distinct search queries shared by the users")
+    load.add_argument('--think-time', type=float, default=0, help="mean pause between a user's updates (ms)")
+    load.add_argument('--channels', type=int, default=1, help="force subscription channels to verify")
+    load.add_argument('--broadcast', action='store_true', help="let the admin broadcast after the users finish")
+    load.add_argument('--pixabay-latency', type=float, default=80, help="Pixabay response latency (ms)")
+    load.add_argument('--pixabay-jitter', type=float, default=20, help="Pixabay latency jitter (ms)")
+    load.add_argument('--pixabay-errors', type=float, default=0.0, help="fraction of Pixabay calls answering 500")
+    load.add_argument('--telegram-latency', type=float, default=40, help="Telegram response latency (ms)")
+    load.add_argument('--telegram-jitter', type=float, default=10, help="Telegram latency jitter (ms)")
+    load.add_argument('--telegram-errors', type=float, default=0.0, help="fraction of Telegram calls answering 500")
+    load.add_argument('--total-hits', type=int, default=500, help="results per query")
+    load.add_argument('--padding', type=int, default=0, help="extra bytes per Pixabay hit")
+    load.add_argument('--media-bytes', type=int, default=64 * 1024, help="size of each served media file")
+    load.add_argument('--seed', type=int, default=1, help="random seed")
+    load.add_argument('--verbose', action='store_true', help="keep the bot's logging")
+    args = parser.parse_args()
+
+    if args.suite == 'memory':
+        bench_result_memory(args.results)
+    else:
+        if not args.verbose:
+            logging.disable(logging.CRITICAL)
+        asyncio.run(bench_load(args))
+
+
+if __name__ == '__main__':
+    main_cli()
@@ -3,13 +3,28 @@ import os
 import logging
 import asyncio
 import json
-from typing import Dict, List, Optional, Any
+import time
+import sqlite3
+import heapq
+import itertools
+import random
+import queue
+import signal
+import multiprocessing
+import bisect
+import functools
+from collections import deque
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Any, Awaitable, Callable, Tuple
 from datetime import datetime
-import requests
-from telegram import Bot, Update, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaPhoto, InputMediaVideo, InputMediaDocument
-from telegram.ext import Application, CommandHandler, CallbackQueryHandler, MessageHandler, filters, ContextTypes
-from flask import Flask, request
-import threading
+import httpx
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+from telegram import Bot, Message, Update, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaAudio, InputMediaPhoto, InputMediaVideo, InputMediaDocument
+from telegram import InlineQueryResultAudio, InlineQueryResultPhoto, InlineQueryResultVideo, InlineQueryResultsButton
+from telegram.request import HTTPXRequest
+from telegram.ext import Application, BaseUpdateProcessor, CommandHandler, CallbackQueryHandler, ChatMemberHandler, ChosenInlineResultHandler, InlineQueryHandler, MessageHandler, filters, ContextTypes
+from aiohttp import web
 
 # Configure logging
 logging.basicConfig(
@@ -28,34 +43,1904 @@ except ValueError:
 PIXABAY_API_KEY = os.getenv('PIXABAY_API_KEY', '51444506-bffefcaf12816bd85a20222d1')
 PORT = int(os.getenv('PORT', '10000'))
 WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')
+# Render sets RENDER and RENDER_EXTERNAL_URL (used when WEBHOOK_URL is empty) on its services
+IS_RENDER = bool(os.getenv('RENDER'))
+RENDER_EXTERNAL_URL = os.getenv('RENDER_EXTERNAL_URL', '')
 # Always use webhook mode
+# Pixabay API root (the benchmark points it at a local stand-in)
+PIXABAY_API_URL = os.getenv('PIXABAY_API_URL', 'https://pixabay.com/api/')
+# Pixabay HTTP client settings
+PIXABAY_POOL_SIZE = int(os.getenv('PIXABAY_POOL_SIZE', '20'))
+PIXABAY_KEEPALIVE_CONNECTIONS = int(os.getenv('PIXABAY_KEEPALIVE_CONNECTIONS', '10'))
+PIXABAY_CONNECT_TIMEOUT = float(os.getenv('PIXABAY_CONNECT_TIMEOUT', '5'))
+PIXABAY_READ_TIMEOUT = float(os.getenv('PIXABAY_READ_TIMEOUT', '10'))
+# Pixabay quota: requests of the rate-limit window kept back for interactive searches
+PIXABAY_BACKGROUND_RESERVE = int(os.getenv('PIXABAY_BACKGROUND_RESERVE', '10'))
+PIXABAY_DEFAULT_RESET = float(os.getenv('PIXABAY_DEFAULT_RESET', '60'))
+# Pixabay resilience: retries with jittered backoff, circuit breaker and optional hedged requests
+PIXABAY_MAX_RETRIES = int(os.getenv('PIXABAY_MAX_RETRIES', '2'))
+PIXABAY_RETRY_BASE_DELAY = float(os.getenv('PIXABAY_RETRY_BASE_DELAY', '0.3'))
+PIXABAY_RETRY_MAX_DELAY = float(os.getenv('PIXABAY_RETRY_MAX_DELAY', '3'))
+PIXABAY_BREAKER_THRESHOLD = int(os.getenv('PIXABAY_BREAKER_THRESHOLD', '5'))
+PIXABAY_BREAKER_COOLDOWN = float(os.getenv('PIXABAY_BREAKER_COOLDOWN', '30'))
+PIXABAY_HEDGE = os.getenv('PIXABAY_HEDGE', 'false').lower() in ('1', 'true', 'yes')
+PIXABAY_HEDGE_MIN_DELAY = float(os.getenv('PIXABAY_HEDGE_MIN_DELAY', '0.2'))
+# Pixabay response cache settings
+SEARCH_CACHE_TTL = float(os.getenv('SEARCH_CACHE_TTL', '600'))
+SEARCH_CACHE_MAX_ENTRIES = int(os.getenv('SEARCH_CACHE_MAX_ENTRIES', '1000'))
+SEARCH_CACHE_MAX_BYTES = int(os.getenv('SEARCH_CACHE_MAX_BYTES', str(32 * 1024 * 1024)))
+# Last good response per query, served while Pixabay is failing
+STALE_CACHE_MAX_ENTRIES = int(os.getenv('STALE_CACHE_MAX_ENTRIES', '2000'))
+STALE_CACHE_MAX_BYTES = int(os.getenv('STALE_CACHE_MAX_BYTES', str(32 * 1024 * 1024)))
+# Result pagination: hits per Pixabay page and how close to the end the next page is loaded
+SEARCH_PAGE_SIZE = int(os.getenv('SEARCH_PAGE_SIZE', '20'))
+SEARCH_PREFETCH_MARGIN = int(os.getenv('SEARCH_PREFETCH_MARGIN', '3'))
+# The 'all' search type queries these sources in parallel ('image' is the image endpoint without a category)
+ALL_SEARCH_SOURCES = ('image', 'video')
+# Search sessions (results being browsed, awaited input): idle lifetime and how many are kept
+SESSION_IDLE_TTL = float(os.getenv('SESSION_IDLE_TTL', '1800'))
+SESSION_MAX_ENTRIES = int(os.getenv('SESSION_MAX_ENTRIES', '10000'))
+# Navigation taps arriving within this many seconds are coalesced into a single message edit
+NAV_DEBOUNCE = float(os.getenv('NAV_DEBOUNCE', '0.3'))
+# Gallery mode: results per album (Telegram allows 2-10 media per group)
+ALBUM_SIZE = max(2, min(10, int(os.getenv('ALBUM_SIZE', '10'))))
+# Flood control: token buckets (rate per second, burst) per action, for each user and for everyone
+# (the global limits are for the whole bot; with WORKERS>1 each worker enforces its share)
+FLOOD_LIMITS = {
+    'search': (float(os.getenv('FLOOD_SEARCH_RATE', '0.5')), float(os.getenv('FLOOD_SEARCH_BURST', '5'))),
+    'navigate': (float(os.getenv('FLOOD_NAVIGATE_RATE', '3')), float(os.getenv('FLOOD_NAVIGATE_BURST', '10')))
+}
+FLOOD_GLOBAL_LIMITS = {
+    'search': (float(os.getenv('FLOOD_GLOBAL_SEARCH_RATE', '20')), float(os.getenv('FLOOD_GLOBAL_SEARCH_BURST', '60'))),
+    'navigate': (float(os.getenv('FLOOD_GLOBAL_NAVIGATE_RATE', '100')), float(os.getenv('FLOOD_GLOBAL_NAVIGATE_BURST', '300')))
+}
+# Callback buttons counted against flood control, by callback_data (or its prefix for suggestions)
+FLOOD_CALLBACK_ACTIONS = {
+    'next_result': 'navigate', 'prev_result': 'navigate',
+    'next_album': 'navigate', 'prev_album': 'navigate',
+    'suggest_': 'search'
+}
+# Past-query index behind the suggestion buttons
+QUERY_INDEX_MAX_ENTRIES = int(os.getenv('QUERY_INDEX_MAX_ENTRIES', '20000'))
+SUGGESTION_COUNT = int(os.getenv('SUGGESTION_COUNT', '5'))
+# Trending pre-warm: refresh period, queries kept warm per search type, warm entry lifetime,
+# share of the Pixabay quota it may use and how fast old demand fades
+TRENDING_INTERVAL = float(os.getenv('TRENDING_INTERVAL', '120'))
+TRENDING_TOP_N = int(os.getenv('TRENDING_TOP_N', '10'))
+TRENDING_WARM_TTL = float(os.getenv('TRENDING_WARM_TTL', '600'))
+TRENDING_QUOTA_SHARE = float(os.getenv('TRENDING_QUOTA_SHARE', '0.1'))
+TRENDING_DECAY = float(os.getenv('TRENDING_DECAY', '0.5'))
+# Decayed search count a query needs before it is kept warm
+TRENDING_MIN_COUNT = float(os.getenv('TRENDING_MIN_COUNT', '2'))
+# Seconds Telegram may cache inline query answers
+INLINE_CACHE_TIME = int(os.getenv('INLINE_CACHE_TIME', '300'))
+# State storage: 'memory' (default, lost on restart) or 'sqlite'
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'memory')
+SQLITE_PATH = os.getenv('SQLITE_PATH', 'bot_data.db')
+STORE_FLUSH_INTERVAL = float(os.getenv('STORE_FLUSH_INTERVAL', '2'))
+STORE_FLUSH_BATCH = int(os.getenv('STORE_FLUSH_BATCH', '500'))
+# Force subscription membership cache: members are trusted longer than non-members
+SUBSCRIPTION_CACHE_TTL = float(os.getenv('SUBSCRIPTION_CACHE_TTL', '600'))
+SUBSCRIPTION_NEGATIVE_TTL = float(os.getenv('SUBSCRIPTION_NEGATIVE_TTL', '10'))
+SUBSCRIPTION_CACHE_MAX_ENTRIES = int(os.getenv('SUBSCRIPTION_CACHE_MAX_ENTRIES', '100000'))
+# Broadcasts: global send rate (Telegram allows ~30 msg/s), parallel sends and users per checkpoint
+BROADCAST_RATE = float(os.getenv('BROADCAST_RATE', '25'))
+BROADCAST_CONCURRENCY = int(os.getenv('BROADCAST_CONCURRENCY', '10'))
+BROADCAST_BATCH_SIZE = int(os.getenv('BROADCAST_BATCH_SIZE', '200'))
+BROADCAST_MAX_RETRIES = int(os.getenv('BROADCAST_MAX_RETRIES', '3'))
+BROADCAST_RETRY_BASE_DELAY = float(os.getenv('BROADCAST_RETRY_BASE_DELAY', '1'))
+# Telegram file_id cache for media already delivered once
+FILE_ID_CACHE_MAX_ENTRIES = int(os.getenv('FILE_ID_CACHE_MAX_ENTRIES', '50000'))
+# Prefetching: results warmed ahead of the one shown, media byte cache limits and idle cut-off
+PREFETCH_AHEAD = int(os.getenv('PREFETCH_AHEAD', '2'))
+PREFETCH_MAX_MEDIA_BYTES = int(os.getenv('PREFETCH_MAX_MEDIA_BYTES', str(5 * 1024 * 1024)))
+MEDIA_CACHE_MAX_BYTES = int(os.getenv('MEDIA_CACHE_MAX_BYTES', str(64 * 1024 * 1024)))
+PREFETCH_IDLE_TIMEOUT = float(os.getenv('PREFETCH_IDLE_TIMEOUT', '30'))
+
+# Webhook server: updates wait in a bounded queue, a full queue answers 429 so Telegram retries later
+UPDATE_QUEUE_SIZE = int(os.getenv('UPDATE_QUEUE_SIZE', '1000'))
+WEBHOOK_RETRY_AFTER = int(os.getenv('WEBHOOK_RETRY_AFTER', '1'))
+# Update processing: different users run in parallel, each user's updates in order with a capped backlog
+UPDATE_CONCURRENCY = int(os.getenv('UPDATE_CONCURRENCY', '64'))
+USER_MAX_PENDING_UPDATES = int(os.getenv('USER_MAX_PENDING_UPDATES', '8'))
+# Scale-out: worker processes behind the webhook receiver, updates routed by user_id (needs STORAGE_BACKEND=sqlite)
+WORKERS = int(os.getenv('WORKERS', '1'))
+# Shutdown: on SIGTERM, updates already accepted and pending renders get this many seconds in all to finish;
+# stragglers are then cancelled and get SHUTDOWN_CANCEL_GRACE seconds to unwind before the store is closed
+DRAIN_TIMEOUT = float(os.getenv('DRAIN_TIMEOUT', '20'))
+SHUTDOWN_CANCEL_GRACE = 1.0
+
+# Validate essential configuration
+if not BOT_TOKEN:
+    logger.error("BOT_TOKEN is required!")
+    exit(1)
+
+if not PIXABAY_API_KEY:
+    logger.error("PIXABAY_API_KEY is required!")
+    exit(1)
+
+# In-memory storage (for production, consider using a database)
+users_data = {}
+force_channels = []  # List of channel usernames
+banned_users = set()
+bot_stats = {
+    'total_users': 0,
+    'total_searches': 0,
+    'start_date': datetime.now().isoformat()
+}
+# Which users this process serves when running as one of several workers
+worker_shard = {'index': 0, 'count': 1}
+# Monotonic time by which shutdown must be done, set once when it begins
+shutdown_state: Dict[str, Optional[float]] = {'deadline': None}
+
+
+def shard_for_user(user_id: int, count: int) -> int:
+    """Return the worker that owns a user"""
+    return user_id % count
+
+
+def owns_user(user_id: int) -> bool:
+    """Whether this process is the worker that owns a user"""
+    return shard_for_user(user_id, worker_shard['count']) == worker_shard['index']
+
+
+def new_user_record(username: str, join_date: Optional[str] = None, search_count: int = 0,
+                    active: bool = True) -> Dict[str, Any]:
+    """Build the users_data entry (the small, permanent profile) for a user"""
+    return {
+        'username': username,
+        'join_date': join_date or datetime.now().isoformat(),
+        'search_count': search_count,
+        'active': active,
+        'selected_search_type': 'all',
+        # Browse results as albums of ALBUM_SIZE instead of one at a time
+        'gallery_mode': False,
+        # query, type and position of the last search, enough to rebuild an expired session
+        'last_search': None
+    }
+
+
+def new_session() -> Dict[str, Any]:
+    """Build the transient search session of a user"""
+    return {
+        'current_search': None,
+        'search_results': [],
+        'search_total': 0,
+        'search_page': 0,
+        'source_totals': {},
+        'current_search_type': 'all',
+        'current_result_index': 0,
+        'waiting_for_search': False
+    }
+
+
+class StateStore:
+    """In-memory state store (default): state lives only in the module globals"""
+
+    async def open(self):
+        """Open the store and load persisted state into the module globals"""
+
+    async def close(self):
+        """Flush pending writes and close the store"""
+
+    def save_user(self, user_id: int, username: str, join_date: str):
+        """Persist a newly joined user"""
+
+    def increment_search_count(self, user_id: int):
+        """Persist one more search for a user and for the bot totals"""
+
+    def set_banned(self, user_id: int, banned: bool):
+        """Persist a ban or unban"""
+
+    def save_channels(self, channels: List[str]):
+        """Persist the force subscription channel list"""
+
+    def set_user_active(self, user_id: int, active: bool):
+        """Persist whether a user can still receive messages"""
+
+    async def fetch_user_ids(self, after: int, limit: int) -> List[int]:
+        """Return up to limit active user ids greater than after, in ascending order"""
+        return heapq.nsmallest(limit, (
+            user_id for user_id, user in users_data.items() if user_id > after and user.get('active', True)
+        ))
+
+    async def count_active_users(self, exclude: int) -> int:
+        """Return how many active users a broadcast reaches, leaving out one user (its admin)"""
+        return sum(1 for user_id, user in users_data.items() if user.get('active', True) and user_id != exclude)
+
+    def save_broadcast(self, job: Dict[str, Any]):
+        """Persist a broadcast job checkpoint"""
+
+    async def load_broadcasts(self) -> List[Dict[str, Any]]:
+        """Return unfinished broadcast jobs"""
+        return []
+
+    def save_file_id(self, key: Tuple[str, int, str], file_id: str):
+        """Persist the Telegram file_id of a delivered Pixabay media"""
+
+    def delete_file_id(self, key: Tuple[str, int, str]):
+        """Forget an evicted or invalid file_id"""
+
+    async def load_file_ids(self, limit: int) -> List[Tuple[Tuple[str, int, str], str]]:
+        """Return up to limit most recently stored file_ids, oldest first"""
+        return []
+
+    async def refresh_shared(self):
+        """Reload state other workers may have changed (bans, channels, totals)"""
+
+
+class SQLiteStateStore(StateStore):
+    """SQLite-backed state store with a write-behind buffer flushed in batched transactions"""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            join_date TEXT,
+            search_count INTEGER NOT NULL DEFAULT 0,
+            active INTEGER NOT NULL DEFAULT 1
+        );
+        -- Broadcasts scan active users in user_id order
+        CREATE INDEX IF NOT EXISTS idx_users_active ON users (active, user_id);
+        -- Ban lookups hit the primary key directly
+        CREATE TABLE IF NOT EXISTS banned_users (user_id INTEGER PRIMARY KEY) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS force_channels (position INTEGER PRIMARY KEY, channel TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS bot_stats (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            job_id INTEGER PRIMARY KEY,
+            admin_id INTEGER NOT NULL,
+            text TEXT NOT NULL,
+            cursor INTEGER NOT NULL,
+            total INTEGER NOT NULL,
+            sent INTEGER NOT NULL,
+            failed INTEGER NOT NULL,
+            pruned INTEGER NOT NULL,
+            status TEXT NOT NULL,
+            started_at TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS file_ids (
+            media_kind TEXT NOT NULL,
+            media_id INTEGER NOT NULL,
+            size TEXT NOT NULL,
+            file_id TEXT NOT NULL,
+            updated_at REAL NOT NULL,
+            PRIMARY KEY (media_kind, media_id, size)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS idx_file_ids_updated ON file_ids (updated_at);
+    """
+
+    def __init__(self, path: str = SQLITE_PATH, flush_interval: float = STORE_FLUSH_INTERVAL,
+                 flush_batch: int = STORE_FLUSH_BATCH):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.flush_batch = flush_batch
+        self.conn: Optional[sqlite3.Connection] = None
+        # All database work runs on one thread so handlers never wait on disk
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sqlite-store')
+        self.pending_users: Dict[int, Tuple[str, str]] = {}
+        self.pending_search_counts: Dict[int, int] = {}
+        self.pending_bans: Dict[int, bool] = {}
+        self.pending_channels: Optional[List[str]] = None
+        self.pending_active: Dict[int, bool] = {}
+        self.pending_broadcasts: Dict[int, Tuple] = {}
+        self.pending_file_ids: Dict[Tuple[str, int, str], Optional[Tuple[str, float]]] = {}
+        self.pending_searches = 0
+        self.pending_count = 0
+        self.flush_wakeup = asyncio.Event()
+        self.dirty = asyncio.Event()
+        self.flush_task: Optional[asyncio.Task] = None
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(self.SCHEMA)
+        conn.execute("INSERT OR IGNORE INTO bot_stats (key, value) VALUES ('start_date', ?)",
+                     (bot_stats['start_date'],))
+        conn.execute("INSERT OR IGNORE INTO bot_stats (key, value) VALUES ('total_searches', '0')")
+        conn.commit()
+        self.conn = conn
+
+    def _load_shared(self) -> Dict[str, Any]:
+        banned = {row[0] for row in self.conn.execute("SELECT user_id FROM banned_users")}
+        channels = [row[0] for row in self.conn.execute("SELECT channel FROM force_channels ORDER BY position")]
+        stats = dict(self.conn.execute("SELECT key, value FROM bot_stats"))
+        total_users = self.conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+        return {'banned': banned, 'channels': channels, 'stats': stats, 'total_users': total_users}
+
+    def _load(self) -> Dict[str, Any]:
+        # A worker only keeps the users routed to it
+        users = {
+            row[0]: new_user_record(row[1], row[2], row[3], bool(row[4]))
+            for row in self.conn.execute(
+                "SELECT user_id, username, join_date, search_count, active FROM users WHERE user_id % ? = ?",
+                (worker_shard['count'], worker_shard['index'])
+            )
+        }
+        return {'users': users, **self._load_shared()}
+
+    def _apply_shared(self, state: Dict[str, Any]):
+        # Local changes not yet flushed win over what was read
+        banned = state['banned']
+        for user_id, is_banned in self.pending_bans.items():
+            if is_banned:
+                banned.add(user_id)
+            else:
+                banned.discard(user_id)
+        banned_users.clear()
+        banned_users.update(banned)
+        force_channels[:] = self.pending_channels if self.pending_channels is not None else state['channels']
+        bot_stats['total_users'] = state['total_users'] + len(self.pending_users)
+        bot_stats['total_searches'] = int(state['stats']['total_searches']) + self.pending_searches
+        bot_stats['start_date'] = state['stats']['start_date']
+
+    async def open(self):
+        await self._run(self._connect)
+        state = await self._run(self._load)
+        
+        users_data.update(state['users'])
+        self._apply_shared(state)
+        
+        self.flush_task = asyncio.create_task(self._flush_loop())
+        logger.info(f"SQLite store opened at {self.path} ({len(users_data)} users, {len(banned_users)} banned)")
+
+    async def close(self):
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+            try:
+                await self.flush_task
+            except asyncio.CancelledError:
+                pass
+            self.flush_task = None
+        await self.flush()
+        if self.conn is not None:
+            await self._run(self.conn.close)
+            self.conn = None
+        self.executor.shutdown(wait=True)
+        logger.info("SQLite store closed")
+
+    def _mark_pending(self):
+        self.pending_count += 1
+        self.dirty.set()
+        if self.pending_count >= self.flush_batch:
+            self.flush_wakeup.set()
+
+    def save_user(self, user_id: int, username: str, join_date: str):
+        self.pending_users[user_id] = (username, join_date)
+        self._mark_pending()
+
+    def increment_search_count(self, user_id: int):
+        self.pending_search_counts[user_id] = self.pending_search_counts.get(user_id, 0) + 1
+        self.pending_searches += 1
+        self._mark_pending()
+
+    def set_banned(self, user_id: int, banned: bool):
+        self.pending_bans[user_id] = banned
+        self._mark_pending()
+
+    def save_channels(self, channels: List[str]):
+        self.pending_channels = list(channels)
+        self._mark_pending()
+
+    def set_user_active(self, user_id: int, active: bool):
+        self.pending_active[user_id] = active
+        self._mark_pending()
+
+    def _fetch_user_ids(self, after: int, limit: int) -> List[int]:
+        return [row[0] for row in self.conn.execute(
+            "SELECT user_id FROM users WHERE active = 1 AND user_id > ? ORDER BY user_id LIMIT ?", (after, limit)
+        )]
+
+    async def fetch_user_ids(self, after: int, limit: int) -> List[int]:
+        # Pending new users must be visible to the scan
+        await self.flush()
+        return await self._run(self._fetch_user_ids, after, limit)
+
+    def _count_active_users(self, exclude: int) -> int:
+        return self.conn.execute(
+            "SELECT COUNT(*) FROM users WHERE active = 1 AND user_id != ?", (exclude,)
+        ).fetchone()[0]
+
+    async def count_active_users(self, exclude: int) -> int:
+        # Every worker's users count, not only the ones loaded here
+        await self.flush()
+        return await self._run(self._count_active_users, exclude)
+
+    BROADCAST_FIELDS = ('job_id', 'admin_id', 'text', 'cursor', 'total', 'sent', 'failed', 'pruned',
+                        'status', 'started_at')
+
+    def save_broadcast(self, job: Dict[str, Any]):
+        self.pending_broadcasts[job['job_id']] = tuple(job[field] for field in self.BROADCAST_FIELDS)
+        self._mark_pending()
+
+    def _load_broadcasts(self) -> List[Dict[str, Any]]:
+        rows = self.conn.execute(
+            f"SELECT {', '.join(self.BROADCAST_FIELDS)} FROM broadcasts WHERE status = 'running' ORDER BY job_id"
+        )
+        return [dict(zip(self.BROADCAST_FIELDS, row)) for row in rows]
+
+    async def load_broadcasts(self) -> List[Dict[str, Any]]:
+        return await self._run(self._load_broadcasts)
+
+    def save_file_id(self, key: Tuple[str, int, str], file_id: str):
+        self.pending_file_ids[key] = (file_id, time.time())
+        self._mark_pending()
+
+    def delete_file_id(self, key: Tuple[str, int, str]):
+        self.pending_file_ids[key] = None
+        self._mark_pending()
+
+    def _load_file_ids(self, limit: int) -> List[Tuple[Tuple[str, int, str], str]]:
+        rows = self.conn.execute(
+            "SELECT media_kind, media_id, size, file_id FROM file_ids ORDER BY updated_at DESC LIMIT ?", (limit,)
+        ).fetchall()
+        return [((kind, media_id, size), file_id) for kind, media_id, size, file_id in reversed(rows)]
+
+    async def load_file_ids(self, limit: int) -> List[Tuple[Tuple[str, int, str], str]]:
+        return await self._run(self._load_file_ids, limit)
+
+    async def refresh_shared(self):
+        self._apply_shared(await self._run(self._load_shared))
+
+    async def _flush_loop(self):
+        while True:
+            if worker_shard['count'] == 1:
+                # Nothing to write and nothing to refresh: sleep until a change arrives
+                await self.dirty.wait()
+            try:
+                await asyncio.wait_for(self.flush_wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            try:
+                await self.flush()
+                if worker_shard['count'] > 1:
+                    await self.refresh_shared()
+            except Exception as e:
+                logger.error(f"Error flushing state store: {e}")
+
+    async def flush(self):
+        """Write all buffered changes in a single transaction"""
+        self.flush_wakeup.clear()
+        self.dirty.clear()
+        if not self.pending_count or self.conn is None:
+            return
+        
+        batch = (self.pending_users, self.pending_search_counts, self.pending_bans,
+                 self.pending_channels, self.pending_searches, self.pending_active, self.pending_broadcasts,
+                 self.pending_file_ids)
+        count = self.pending_count
+        self.pending_users = {}
+        self.pending_search_counts = {}
+        self.pending_bans = {}
+        self.pending_channels = None
+        self.pending_searches = 0
+        self.pending_active = {}
+        self.pending_broadcasts = {}
+        self.pending_file_ids = {}
+        self.pending_count = 0
+        try:
+            await self._run(self._write_batch, *batch)
+        except Exception:
+            # The transaction rolled back: keep the changes for the next flush
+            self._restore_batch(count, *batch)
+            raise
+
+    def _restore_batch(self, count, new_users, search_counts, bans, channels, searches, active, broadcasts, file_ids):
+        # Changes buffered while the batch was being written are newer and win
+        new_users.update(self.pending_users)
+        for user_id, added in self.pending_search_counts.items():
+            search_counts[user_id] = search_counts.get(user_id, 0) + added
+        bans.update(self.pending_bans)
+        active.update(self.pending_active)
+        broadcasts.update(self.pending_broadcasts)
+        file_ids.update(self.pending_file_ids)
+        self.pending_users = new_users
+        self.pending_search_counts = search_counts
+        self.pending_bans = bans
+        if self.pending_channels is None:
+            self.pending_channels = channels
+        self.pending_searches += searches
+        self.pending_active = active
+        self.pending_broadcasts = broadcasts
+        self.pending_file_ids = file_ids
+        self.pending_count += count
+        self.dirty.set()
+
+    def _write_batch(self, new_users, search_counts, bans, channels, searches, active, broadcasts, file_ids):
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO users (user_id, username, join_date) VALUES (?, ?, ?)",
+                [(user_id, username, join_date) for user_id, (username, join_date) in new_users.items()]
+            )
+            self.conn.executemany(
+                "UPDATE users SET search_count = search_count + ? WHERE user_id = ?",
+                [(count, user_id) for user_id, count in search_counts.items()]
+            )
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO banned_users (user_id) VALUES (?)",
+                [(user_id,) for user_id, banned in bans.items() if banned]
+            )
+            self.conn.executemany(
+                "DELETE FROM banned_users WHERE user_id = ?",
+                [(user_id,) for user_id, banned in bans.items() if not banned]
+            )
+            if channels is not None:
+                self.conn.execute("DELETE FROM force_channels")
+                self.conn.executemany(
+                    "INSERT INTO force_channels (position, channel) VALUES (?, ?)",
+                    list(enumerate(channels))
+                )
+            if searches:
+                self.conn.execute(
+                    "UPDATE bot_stats SET value = CAST(value AS INTEGER) + ? WHERE key = 'total_searches'",
+                    (searches,)
+                )
+            self.conn.executemany(
+                "UPDATE users SET active = ? WHERE user_id = ?",
+                [(int(is_active), user_id) for user_id, is_active in active.items()]
+            )
+            self.conn.executemany(
+                f"INSERT OR REPLACE INTO broadcasts ({', '.join(self.BROADCAST_FIELDS)}) "
+                f"VALUES ({', '.join('?' * len(self.BROADCAST_FIELDS))})",
+                list(broadcasts.values())
+            )
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO file_ids (media_kind, media_id, size, file_id, updated_at) VALUES (?, ?, ?, ?, ?)",
+                [(*key, *value) for key, value in file_ids.items() if value is not None]
+            )
+            self.conn.executemany(
+                "DELETE FROM file_ids WHERE media_kind = ? AND media_id = ? AND size = ?",
+                [key for key, value in file_ids.items() if value is None]
+            )
+
+
+def create_state_store() -> StateStore:
+    """Create the state store selected by STORAGE_BACKEND"""
+    if STORAGE_BACKEND == 'sqlite':
+        return SQLiteStateStore()
+    if STORAGE_BACKEND != 'memory':
+        logger.error(f"Unknown STORAGE_BACKEND '{STORAGE_BACKEND}', using in-memory storage")
+    return StateStore()
+
+
+class Histogram:
+    """Labelled latency histogram; observe() is a bisect and two additions"""
+
+    def __init__(self, name: str, help_text: str, labelnames: Tuple[str, ...],
+                 buckets: Tuple[float, ...] = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self.series: Dict[Tuple[str, ...], List[Any]] = {}  # label values -> [bucket counts, sum, count]
+
+    def observe(self, value: float, *labels: Any):
+        """Record one observation for the given label values"""
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for labels, (counts, total, count) in sorted(self.series.items(), key=lambda item: str(item[0])):
+            label_text = ','.join(f'{name}="{value}"' for name, value in zip(self.labelnames, labels))
+            prefix = f"{label_text}," if label_text else ''
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f'{self.name}_bucket{{{prefix}le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_bucket{{{prefix}le="+Inf"}} {count}')
+            suffix = f"{{{label_text}}}" if label_text else ''
+            lines.append(f"{self.name}_sum{suffix} {total}")
+            lines.append(f"{self.name}_count{suffix} {count}")
+        return lines
+
+
+class MetricsRegistry:
+    """Prometheus text exposition: histograms are updated inline, gauges are only computed on scrape"""
+
+    def __init__(self):
+        self.histograms: Dict[str, Histogram] = {}
+        self.collectors: Dict[str, Tuple[str, str, Tuple[str, ...], Callable[[], Any]]] = {}
+
+    def histogram(self, name: str, help_text: str, labelnames: Tuple[str, ...]) -> Histogram:
+        """Create (or return) a histogram"""
+        if name not in self.histograms:
+            self.histograms[name] = Histogram(name, help_text, labelnames)
+        return self.histograms[name]
+
+    def register(self, name: str, kind: str, help_text: str, collect: Callable[[], Any],
+                 labelnames: Tuple[str, ...] = ()):
+        """Register a gauge or counter read by collect() at scrape time
+
+        collect() returns a number, or a dict of label values -> number when labelnames are given.
+        Registering a name again replaces the previous collector.
+        """
+        self.collectors[name] = (kind, help_text, labelnames, collect)
+
+    def render(self) -> str:
+        lines = []
+        for name, (kind, help_text, labelnames, collect) in self.collectors.items():
+            try:
+                value = collect()
+            except Exception as e:
+                logger.warning(f"Metric {name} failed: {e}")
+                continue
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            if labelnames:
+                for labels, sample in value.items():
+                    label_text = ','.join(f'{label}="{label_value}"' for label, label_value in zip(labelnames, labels))
+                    lines.append(f"{name}{{{label_text}}} {float(sample)}")
+            else:
+                lines.append(f"{name} {float(value)}")
+        for histogram in self.histograms.values():
+            lines.extend(histogram.render())
+        return '\n'.join(lines) + '\n'
+
+
+metrics = MetricsRegistry()
+HANDLER_LATENCY = metrics.histogram('bot_handler_duration_seconds', "Update handler latency", ('handler',))
+PIXABAY_LATENCY = metrics.histogram('bot_pixabay_request_duration_seconds', "Pixabay API request latency",
+                                    ('endpoint', 'status'))
+TELEGRAM_LATENCY = metrics.histogram('bot_telegram_request_duration_seconds', "Telegram Bot API request latency",
+                                     ('method', 'status'))
+
+
+def timed_handler(func):
+    """Record the latency of an async handler method in HANDLER_LATENCY"""
+    name = func.__name__
+    
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            HANDLER_LATENCY.observe(time.perf_counter() - started, name)
+    return wrapper
+
+
+class InstrumentedRequest(HTTPXRequest):
+    """Telegram request backend recording Bot API latency per method and status"""
+
+    async def do_request(self, url: str, method: str, *args, **kwargs) -> Tuple[int, bytes]:
+        started = time.perf_counter()
+        status = 'error'
+        try:
+            code, payload = await super().do_request(url, method, *args, **kwargs)
+            status = code
+            return code, payload
+        finally:
+            TELEGRAM_LATENCY.observe(time.perf_counter() - started, url.rsplit('/', 1)[-1], status)
+
+# Priorities of outbound Pixabay calls (lower runs first)
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 1
+
+
+class QuotaScheduler:
+    """Admits Pixabay API calls against the live X-RateLimit budget, interactive calls first
+
+    The budget is learned from the X-RateLimit-* headers of every response. While it
+    lasts calls go straight through; once it runs low they wait in a priority queue
+    until the window resets. Background calls also leave a reserve for interactive ones.
+    """
+
+    def __init__(self, background_reserve: int = PIXABAY_BACKGROUND_RESERVE):
+        self.background_reserve = background_reserve
+        self.limit: Optional[int] = None
+        self.remaining: Optional[int] = None
+        self.reset_at = 0.0
+        self.in_flight = 0
+        self.waiters: List[Tuple[int, int, asyncio.Future]] = []
+        self.sequence = itertools.count()
+        self.wakeup: Optional[asyncio.TimerHandle] = None
+        self.queued_total = 0
+
+    def _can_admit(self, priority: int) -> bool:
+        if self.remaining is None:
+            return True  # No headers seen yet
+        if time.monotonic() >= self.reset_at:
+            self.remaining = self.limit
+        reserve = self.background_reserve if priority > PRIORITY_INTERACTIVE else 0
+        return self.remaining - self.in_flight > reserve
+
+    async def acquire(self, priority: int = PRIORITY_INTERACTIVE,
+                      on_queued: Optional[Callable[[], Awaitable[Any]]] = None):
+        """Wait for a slot in the quota; on_queued is awaited if the call has to wait"""
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiters, (priority, next(self.sequence), future))
+        self._dispatch()
+        if future.done():
+            return
+        
+        self.queued_total += 1
+        try:
+            if on_queued is not None:
+                try:
+                    await on_queued()
+                except Exception as e:
+                    logger.error(f"Error sending queued notice: {e}")
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Admitted just as we were cancelled: give the slot back
+                self.release(None)
+            else:
+                future.cancel()
+            raise
+
+    def release(self, response: Optional[httpx.Response]):
+        """Free a slot and update the budget from the response headers"""
+        self.in_flight -= 1
+        if response is not None:
+            self._update_budget(response)
+        self._dispatch()
+
+    def _update_budget(self, response: httpx.Response):
+        headers = response.headers
+        try:
+            if 'X-RateLimit-Limit' in headers:
+                self.limit = int(headers['X-RateLimit-Limit'])
+            if 'X-RateLimit-Remaining' in headers:
+                self.remaining = int(headers['X-RateLimit-Remaining'])
+            if 'X-RateLimit-Reset' in headers:
+                self.reset_at = time.monotonic() + float(headers['X-RateLimit-Reset'])
+        except ValueError:
+            logger.warning("Invalid Pixabay rate-limit headers")
+        if response.status_code == 429:
+            self.remaining = 0
+            if 'X-RateLimit-Reset' not in headers:
+                self.reset_at = time.monotonic() + PIXABAY_DEFAULT_RESET
+            if self.limit is None:
+                self.limit = 1
+
+    def _dispatch(self):
+        while self.waiters:
+            priority, _, future = self.waiters[0]
+            if future.done():
+                heapq.heappop(self.waiters)
+                continue
+            if not self._can_admit(priority):
+                break
+            heapq.heappop(self.waiters)
+            self.in_flight += 1
+            future.set_result(None)
+        
+        if self.waiters and self.wakeup is None:
+            delay = max(self.reset_at - time.monotonic(), 0.1)
+            self.wakeup = asyncio.get_running_loop().call_later(delay, self._on_reset)
+
+    def _on_reset(self):
+        self.wakeup = None
+        self._dispatch()
+
+    def stats(self) -> Dict[str, Any]:
+        """Return the current budget and queue size"""
+        return {
+            'limit': self.limit,
+            'remaining': self.remaining,
+            'in_flight': self.in_flight,
+            'queued': sum(1 for _, _, future in self.waiters if not future.done()),
+            'queued_total': self.queued_total
+        }
+
+
+class PixabayUnavailable(Exception):
+    """Raised without calling Pixabay while the circuit breaker is open"""
+
+
+class CircuitBreaker:
+    """Opens after consecutive failures and lets one probe through after a cooldown"""
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, threshold: int = PIXABAY_BREAKER_THRESHOLD, cooldown: float = PIXABAY_BREAKER_COOLDOWN):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.opened_total = 0
+
+    def allow(self) -> bool:
+        """Return whether a call may go to Pixabay now"""
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.cooldown:
+            self.state = self.HALF_OPEN
+            return True
+        return False
+
+    def record_success(self):
+        self.state = self.CLOSED
+        self.failures = 0
+
+    def record_abandoned(self):
+        """A call ended without a verdict (cancelled, unexpected error): a lost probe reopens the breaker"""
+        if self.state == self.HALF_OPEN:
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.threshold:
+            if self.state != self.OPEN:
+                self.opened_total += 1
+                logger.warning(f"Pixabay circuit breaker opened after {self.failures} failures")
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+
+
+class PixabayClient:
+    """Shared async HTTP client for Pixabay with keep-alive connection pooling"""
+
+    def __init__(self, pool_size: int = PIXABAY_POOL_SIZE,
+                 keepalive_connections: int = PIXABAY_KEEPALIVE_CONNECTIONS,
+                 connect_timeout: float = PIXABAY_CONNECT_TIMEOUT,
+                 read_timeout: float = PIXABAY_READ_TIMEOUT):
+        self.limits = httpx.Limits(
+            max_connections=pool_size,
+            max_keepalive_connections=min(keepalive_connections, pool_size)
+        )
+        self.timeout = httpx.Timeout(read_timeout, connect=connect_timeout, pool=connect_timeout)
+        self.client: Optional[httpx.AsyncClient] = None
+        self.scheduler = QuotaScheduler()
+        self.breaker = CircuitBreaker()
+        self.hedge = PIXABAY_HEDGE
+        self.latencies: deque = deque(maxlen=200)
+        self.metrics = {'requests': 0, 'retries': 0, 'failures': 0, 'hedges': 0, 'hedge_wins': 0}
+
+    async def open(self):
+        """Open the pooled client (called when the bot starts)"""
+        if self.client is None:
+            self.client = httpx.AsyncClient(limits=self.limits, timeout=self.timeout)
+            logger.info(f"Pixabay client opened (pool size: {self.limits.max_connections})")
+
+    async def close(self):
+        """Close the pooled client (called when the bot stops)"""
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+            logger.info("Pixabay client closed")
+
+    async def get_json(self, url: str, params: Dict[str, Any], priority: int = PRIORITY_INTERACTIVE,
+                       on_queued: Optional[Callable[[], Awaitable[Any]]] = None) -> Tuple[Dict[str, Any], int]:
+        """GET a Pixabay endpoint within the quota and return the decoded JSON body with its size in bytes
+
+        Transport errors and 5xx responses are retried with jittered exponential backoff
+        (searches are idempotent). Raises PixabayUnavailable while the circuit breaker is open.
+        """
+        if self.client is None:
+            raise RuntimeError("Pixabay client is not open")
+        if not self.breaker.allow():
+            raise PixabayUnavailable("Pixabay circuit breaker is open")
+        
+        try:
+            for attempt in range(PIXABAY_MAX_RETRIES + 1):
+                try:
+                    if self.hedge:
+                        response = await self._hedged_request(url, params, priority, on_queued)
+                    else:
+                        response = await self._request(url, params, priority, on_queued)
+                    response.raise_for_status()
+                except (httpx.TransportError, httpx.HTTPStatusError) as e:
+                    retryable = isinstance(e, httpx.TransportError) or e.response.status_code >= 500
+                    if not retryable:
+                        # Client errors say nothing about Pixabay's health
+                        self.breaker.record_success()
+                        raise
+                    if attempt == PIXABAY_MAX_RETRIES:
+                        self.metrics['failures'] += 1
+                        self.breaker.record_failure()
+                        raise
+                    self.metrics['retries'] += 1
+                    on_queued = None  # Notify the user only once
+                    # Full jitter keeps retries from many users from arriving together
+                    delay = min(PIXABAY_RETRY_MAX_DELAY, PIXABAY_RETRY_BASE_DELAY * 2 ** attempt)
+                    await asyncio.sleep(random.uniform(0, delay))
+                    continue
+                
+                self.breaker.record_success()
+                return response.json(), len(response.content)
+        except BaseException:
+            # Otherwise a half-open probe that was cancelled or failed oddly would lock the breaker
+            self.breaker.record_abandoned()
+            raise
+
+    async def _request(self, url: str, params: Dict[str, Any], priority: int,
+                       on_queued: Optional[Callable[[], Awaitable[Any]]],
+                       admitted: Optional[asyncio.Event] = None) -> httpx.Response:
+        # A 429 means our budget was stale; the scheduler now holds the call until the reset
+        for attempt in range(2):
+            await self.scheduler.acquire(priority, on_queued)
+            if admitted is not None:
+                admitted.set()
+            response = None
+            started = time.monotonic()
+            try:
+                self.metrics['requests'] += 1
+                response = await self.client.get(url, params=params)
+            finally:
+                self.scheduler.release(response)
+                PIXABAY_LATENCY.observe(time.monotonic() - started, httpx.URL(url).path,
+                                        response.status_code if response is not None else 'error')
+            if response.status_code != 429:
+                break
+            on_queued = None
+        
+        if response.status_code < 500:
+            self.latencies.append(time.monotonic() - started)
+        return response
+
+    def hedge_delay(self) -> float:
+        """Return the p95 of recent Pixabay latencies, used as the hedging delay"""
+        if len(self.latencies) < 20:
+            return max(PIXABAY_HEDGE_MIN_DELAY, PIXABAY_READ_TIMEOUT / 4)
+        ordered = sorted(self.latencies)
+        return max(PIXABAY_HEDGE_MIN_DELAY, ordered[int(len(ordered) * 0.95) - 1])
+
+    async def _hedged_request(self, url: str, params: Dict[str, Any], priority: int,
+                              on_queued: Optional[Callable[[], Awaitable[Any]]]) -> httpx.Response:
+        """Send a second attempt if the first is slower than the p95 latency; first answer wins"""
+        admitted = asyncio.Event()
+        primary = asyncio.create_task(self._request(url, params, priority, on_queued, admitted))
+        admission = asyncio.create_task(admitted.wait())
+        pending = {primary}
+        try:
+            # The hedge delay starts once the quota lets the primary through: time spent waiting
+            # for quota is not a slow Pixabay, and a duplicate then would only deepen the shortage
+            await asyncio.wait({primary, admission}, return_when=asyncio.FIRST_COMPLETED)
+            done, _ = await asyncio.wait({primary}, timeout=self.hedge_delay())
+            if done:
+                return primary.result()
+            
+            self.metrics['hedges'] += 1
+            hedge = asyncio.create_task(self._request(url, params, priority, None))
+            pending = {primary, hedge}
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is hedge:
+                            self.metrics['hedge_wins'] += 1
+                        return task.result()
+            # Both attempts failed: surface the primary's error
+            return primary.result()
+        finally:
+            admission.cancel()
+            for task in pending:
+                task.cancel()
+
+    def stats(self) -> Dict[str, Any]:
+        """Return resilience metrics"""
+        return {
+            **self.metrics,
+            'breaker_state': self.breaker.state,
+            'breaker_opened': self.breaker.opened_total
+        }
+
+    async def get_bytes(self, url: str, max_bytes: int) -> Optional[bytes]:
+        """Download a media file, or return None if it is larger than max_bytes"""
+        if self.client is None:
+            raise RuntimeError("Pixabay client is not open")
+        async with self.client.stream('GET', url) as response:
+            response.raise_for_status()
+            if int(response.headers.get('content-length', 0)) > max_bytes:
+                return None
+            chunks = []
+            size = 0
+            async for chunk in response.aiter_bytes():
+                size += len(chunk)
+                if size > max_bytes:
+                    return None
+                chunks.append(chunk)
+        return b''.join(chunks)
+
+
+class ResponseCache:
+    """In-process TTL + LRU cache for Pixabay responses with single-flight misses"""
+
+    def __init__(self, ttl: float = SEARCH_CACHE_TTL, max_entries: int = SEARCH_CACHE_MAX_ENTRIES,
+                 max_bytes: int = SEARCH_CACHE_MAX_BYTES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries: OrderedDict = OrderedDict()  # key -> (expires_at, size, value)
+        self.stale: OrderedDict = OrderedDict()  # key -> (size, last good value), kept past its TTL
+        self.max_stale_entries = STALE_CACHE_MAX_ENTRIES
+        self.max_stale_bytes = STALE_CACHE_MAX_BYTES
+        self.stale_bytes = 0
+        self.inflight: Dict[Tuple, asyncio.Future] = {}
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.stale_served = 0
+
+    @staticmethod
+    def make_key(query: str, search_type: str, lang: str, safesearch: str, endpoint: str,
+                 page: int = 1) -> Tuple:
+        """Build a normalized cache key for a Pixabay search"""
+        return (normalize_query(query), search_type, lang, safesearch, endpoint, page)
+
+    def get(self, key: Tuple) -> Optional[Any]:
+        """Return a fresh cached value or None"""
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        expires_at, size, value = entry
+        if expires_at < time.monotonic():
+            self._remove(key)
+            return None
+        self.entries.move_to_end(key)
+        return value
+
+    def peek(self, key: Tuple) -> Optional[Tuple[float, Any]]:
+        """Return (expires_at, value) of a fresh entry without counting a lookup or touching the LRU order"""
+        entry = self.entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            return None
+        return entry[0], entry[2]
+
+    def put(self, key: Tuple, value: Any, size: int):
+        """Store a value, evicting least recently used entries past the limits"""
+        if size > self.max_bytes:
+            return
+        if key in self.entries:
+            self._remove(key)
+        self.entries[key] = (time.monotonic() + self.ttl, size, value)
+        self.total_bytes += size
+        while len(self.entries) > self.max_entries or self.total_bytes > self.max_bytes:
+            self._remove(next(iter(self.entries)))
+        
+        if key in self.stale:
+            self.stale_bytes -= self.stale.pop(key)[0]
+        self.stale[key] = (size, value)
+        self.stale_bytes += size
+        while len(self.stale) > self.max_stale_entries or self.stale_bytes > self.max_stale_bytes:
+            _, (stale_size, _) = self.stale.popitem(last=False)
+            self.stale_bytes -= stale_size
+
+    def _remove(self, key: Tuple):
+        _, size, _ = self.entries.pop(key)
+        self.total_bytes -= size
+
+    async def get_or_fetch(self, key: Tuple, fetch: Callable[[], Awaitable[Tuple[Any, int]]]) -> Any:
+        """Return a cached value or fetch it, sharing one in-flight request per key"""
+        value = self.get(key)
+        if value is not None:
+            self.hits += 1
+            return value
+        
+        pending = self.inflight.get(key)
+        if pending is not None:
+            self.coalesced += 1
+            try:
+                return await asyncio.shield(pending)
+            except asyncio.CancelledError:
+                if not pending.cancelled() or asyncio.current_task().cancelling():
+                    raise
+                # Only the leading request was cancelled: fetch on our own
+                return await self.get_or_fetch(key, fetch)
+        
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        # Avoid "exception was never retrieved" warnings when nobody else is waiting
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self.inflight[key] = future
+        try:
+            value, size = await fetch()
+            self.put(key, value, size)
+        except Exception as e:
+            # Pixabay is failing: fall back to the last good response for this query
+            value = self.stale.get(key, (0, None))[1]
+            if value is None:
+                future.set_exception(e)
+                raise
+            self.stale_served += 1
+            logger.warning(f"Serving stale Pixabay response after error: {e}")
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            self.inflight.pop(key, None)
+        future.set_result(value)
+        return value
+
+    def stats(self) -> Dict[str, Any]:
+        """Return cache counters"""
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self.entries),
+            'bytes': self.total_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced,
+            'stale_served': self.stale_served,
+            'hit_ratio': self.hits / lookups if lookups else 0.0
+        }
+
+
+class TokenBucket:
+    """Token bucket rate limiter"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self, tokens: float = 1.0) -> bool:
+        """Take tokens if available without waiting"""
+        self._refill()
+        if self.tokens >= tokens:
+            self.tokens -= tokens
+            return True
+        return False
+
+    async def acquire(self, tokens: float = 1.0):
+        """Wait until tokens are available and take them"""
+        while not self.try_acquire(tokens):
+            await asyncio.sleep((tokens - self.tokens) / self.rate)
+
+
+class FloodControl:
+    """Per-user and global token buckets for each throttled action
+
+    A bucket idle long enough to refill completely is dropped, as a new one would be
+    identical, so the state stays proportional to the recently active users. With several
+    worker processes each enforces its share of the global limits, users being spread evenly
+    across workers by user_id.
+    """
+
+    def __init__(self, limits: Dict[str, Tuple[float, float]] = FLOOD_LIMITS,
+                 global_limits: Dict[str, Tuple[float, float]] = FLOOD_GLOBAL_LIMITS):
+        self.limits = limits
+        workers = worker_shard['count']
+        self.global_buckets = {action: TokenBucket(rate / workers, max(1.0, burst / workers))
+                               for action, (rate, burst) in global_limits.items()}
+        # (user_id, action) -> bucket, least recently used first
+        self.buckets: OrderedDict = OrderedDict()
+        self.warned: set = set()
+        self.throttled: Dict[str, int] = {action: 0 for action in limits}
+
+    def _evict(self):
+        now = time.monotonic()
+        while self.buckets:
+            key, bucket = next(iter(self.buckets.items()))
+            if now - bucket.updated < (bucket.capacity - bucket.tokens) / bucket.rate:
+                break
+            del self.buckets[key]
+            self.warned.discard(key)
+
+    def check(self, user_id: int, action: str) -> float:
+        """Take a token for the action; return 0 if allowed, else the seconds to wait"""
+        self._evict()
+        key = (user_id, action)
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = TokenBucket(*self.limits[action])
+        else:
+            self.buckets.move_to_end(key)
+        
+        if bucket.try_acquire():
+            global_bucket = self.global_buckets.get(action)
+            if global_bucket is None or global_bucket.try_acquire():
+                self.warned.discard(key)
+                return 0.0
+            # The user is within their own limit: give their token back
+            bucket.tokens += 1
+            bucket = global_bucket
+        self.throttled[action] += 1
+        return (1 - bucket.tokens) / bucket.rate
+
+    def first_warning(self, user_id: int, action: str) -> bool:
+        """Return True once per throttled streak, so a flood is not answered message by message"""
+        key = (user_id, action)
+        if key in self.warned:
+            return False
+        self.warned.add(key)
+        return True
+
+
+class BroadcastEngine:
+    """Runs broadcasts as background jobs with rate limiting and resumable checkpoints
+
+    Users are scanned in user_id order in batches; the cursor is checkpointed to the
+    state store after every batch so an interrupted job resumes where it stopped.
+    Each chat receives a single message per job, so Telegram's per-chat limit is never
+    approached; the global limit is enforced by a token bucket and RetryAfter pauses
+    every sender.
+    """
+
+    def __init__(self, store: StateStore, rate: float = BROADCAST_RATE,
+                 concurrency: int = BROADCAST_CONCURRENCY, batch_size: int = BROADCAST_BATCH_SIZE):
+        self.store = store
+        # A one-token bucket: a full bucket of rate tokens would let the first second send twice the rate
+        self.limiter = TokenBucket(rate, 1)
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.paused_until = 0.0
+        self.job: Optional[Dict[str, Any]] = None
+        self.task: Optional[asyncio.Task] = None
+
+    def is_running(self) -> bool:
+        return self.task is not None and not self.task.done()
+
+    async def start(self, bot: Bot, text: str, admin_id: int) -> Dict[str, Any]:
+        """Start a new broadcast job in the background"""
+        total = await self.store.count_active_users(admin_id)
+        job = {
+            'job_id': int(time.time() * 1000),
+            'admin_id': admin_id,
+            'text': text,
+            'cursor': 0,
+            'total': total,
+            'sent': 0,
+            'failed': 0,
+            'pruned': 0,
+            'status': 'running',
+            'started_at': datetime.now().isoformat()
+        }
+        self.store.save_broadcast(job)
+        self._launch(bot, job)
+        return job
+
+    async def resume(self, bot: Bot):
+        """Resume an interrupted broadcast job after a restart"""
+        # With several workers the job belongs to the one serving its admin
+        jobs = [job for job in await self.store.load_broadcasts() if owns_user(job['admin_id'])]
+        if jobs and not self.is_running():
+            logger.info(f"Resuming broadcast {jobs[-1]['job_id']} after user {jobs[-1]['cursor']}")
+            self._launch(bot, jobs[-1])
+
+    async def stop(self):
+        """Stop the running job; it stays 'running' in the store and resumes on next start"""
+        if self.is_running():
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+
+    def _launch(self, bot: Bot, job: Dict[str, Any]):
+        self.job = job
+        self.task = asyncio.create_task(self._run(bot, job))
+
+    async def _run(self, bot: Bot, job: Dict[str, Any]):
+        semaphore = asyncio.Semaphore(self.concurrency)
+        try:
+            while True:
+                user_ids = await self.store.fetch_user_ids(job['cursor'], self.batch_size)
+                if not user_ids:
+                    break
+                await asyncio.gather(*[
+                    self._send(bot, job, user_id, semaphore) for user_id in user_ids if user_id != job['admin_id']
+                ])
+                job['cursor'] = user_ids[-1]
+                self.store.save_broadcast(job)
+            job['status'] = 'done'
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Broadcast {job['job_id']} failed: {e}")
+            job['status'] = 'failed'
+        self.store.save_broadcast(job)
+        
+        try:
+            await bot.send_message(
+                chat_id=job['admin_id'],
+                text=f"✅ تم إرسال الرسالة إلى {job['sent']} مستخدم\n"
+                     f"❌ فشل الإرسال إلى {job['failed']} مستخدم\n"
+                     f"🧹 تم حذف {job['pruned']} مستخدم محظور أو محذوف"
+            )
+        except Exception as e:
+            logger.error(f"Failed to send broadcast report: {e}")
+
+    async def _wait_for_slot(self):
+        delay = self.paused_until - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        await self.limiter.acquire()
+
+    async def _send(self, bot: Bot, job: Dict[str, Any], user_id: int, semaphore: asyncio.Semaphore):
+        async with semaphore:
+            for attempt in range(BROADCAST_MAX_RETRIES + 1):
+                await self._wait_for_slot()
+                try:
+                    await bot.send_message(chat_id=user_id, text=job['text'])
+                    job['sent'] += 1
+                    return
+                except RetryAfter as e:
+                    # Flood limit hit: pause every sender, then retry this user
+                    self.paused_until = max(self.paused_until, time.monotonic() + float(e.retry_after))
+                except (Forbidden, BadRequest) as e:
+                    if isinstance(e, BadRequest) and 'chat not found' not in str(e).lower():
+                        logger.error(f"Failed to send broadcast to {user_id}: {e}")
+                        break
+                    # Bot blocked or account deleted: stop messaging this user
+                    self.prune_user(user_id)
+                    job['pruned'] += 1
+                    return
+                except NetworkError as e:
+                    # Timeouts and connection errors are transient: back off with full jitter and retry
+                    if attempt == BROADCAST_MAX_RETRIES:
+                        logger.error(f"Failed to send broadcast to {user_id}: {e}")
+                        break
+                    await asyncio.sleep(random.uniform(0, BROADCAST_RETRY_BASE_DELAY * 2 ** attempt))
+                except Exception as e:
+                    logger.error(f"Failed to send broadcast to {user_id}: {e}")
+                    break
+            job['failed'] += 1
+
+    def prune_user(self, user_id: int):
+        """Exclude a user who blocked the bot from further broadcasts"""
+        if user_id in users_data:
+            users_data[user_id]['active'] = False
+        self.store.set_user_active(user_id, False)
+
+    def progress_text(self) -> str:
+        """Describe the progress of the current or last job"""
+        job = self.job
+        if job is None:
+            return "لا يوجد إشعار جاري"
+        done = job['sent'] + job['failed'] + job['pruned']
+        status = {'running': '⏳ جاري الإرسال', 'done': '✅ اكتمل', 'failed': '❌ فشل'}[job['status']]
+        return (f"{status}: {done} من {job['total']}\n"
+                f"✅ تم الإرسال: {job['sent']} | ❌ فشل: {job['failed']} | 🧹 محذوفون: {job['pruned']}")
+
+
+class SessionStore:
+    """Per-user search sessions, dropped after SESSION_IDLE_TTL idle seconds or when over the LRU cap"""
+
+    def __init__(self, idle_ttl: float = SESSION_IDLE_TTL, max_entries: int = SESSION_MAX_ENTRIES):
+        self.idle_ttl = idle_ttl
+        self.max_entries = max_entries
+        self.entries: OrderedDict = OrderedDict()  # user_id -> (session, last_used)
+        self.expired = 0
+        self.evicted = 0
+
+    def _expire(self, now: float):
+        # Entries are kept in last-use order, so the idle ones are at the front
+        while self.entries:
+            _, last_used = next(iter(self.entries.values()))
+            if now - last_used < self.idle_ttl:
+                break
+            self.entries.popitem(last=False)
+            self.expired += 1
+
+    def get(self, user_id: int) -> Optional[Dict[str, Any]]:
+        """Return a user's live session, or None if there is none or it expired"""
+        now = time.monotonic()
+        self._expire(now)
+        entry = self.entries.get(user_id)
+        if entry is None:
+            return None
+        self.entries[user_id] = (entry[0], now)
+        self.entries.move_to_end(user_id)
+        return entry[0]
+
+    def get_or_create(self, user_id: int) -> Dict[str, Any]:
+        """Return a user's session, starting a new one if needed"""
+        session = self.get(user_id)
+        if session is None:
+            session = new_session()
+            self.entries[user_id] = (session, time.monotonic())
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evicted += 1
+        return session
+
+    def peek(self, user_id: int) -> Optional[Dict[str, Any]]:
+        """Return a user's session without counting it as used"""
+        entry = self.entries.get(user_id)
+        return entry[0] if entry is not None else None
+
+    def stored_results(self) -> int:
+        """Return the number of search results held by all sessions"""
+        return sum(len(session['search_results']) for session, _ in self.entries.values())
+
+
+class MembershipCache:
+    """Per-(user, channel) force subscription cache with a short TTL for non-members"""
+
+    def __init__(self, ttl: float = SUBSCRIPTION_CACHE_TTL, negative_ttl: float = SUBSCRIPTION_NEGATIVE_TTL,
+                 max_entries: int = SUBSCRIPTION_CACHE_MAX_ENTRIES):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.entries: OrderedDict = OrderedDict()  # (user_id, channel) -> (is_member, expires_at)
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _key(user_id: int, channel: str) -> Tuple[int, str]:
+        # Telegram usernames are case-insensitive
+        return user_id, channel.lower()
+
+    def get(self, user_id: int, channel: str) -> Optional[bool]:
+        """Return the cached membership, or None if unknown or expired"""
+        key = self._key(user_id, channel)
+        entry = self.entries.get(key)
+        if entry is None or entry[1] < time.monotonic():
+            if entry is not None:
+                del self.entries[key]
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry[0]
+
+    def set(self, user_id: int, channel: str, is_member: bool):
+        """Record a membership result"""
+        key = self._key(user_id, channel)
+        ttl = self.ttl if is_member else self.negative_ttl
+        self.entries[key] = (is_member, time.monotonic() + ttl)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def forget_channel(self, channel: str):
+        """Drop every entry for a channel that is no longer required"""
+        channel = channel.lower()
+        for key in [key for key in self.entries if key[1] == channel]:
+            del self.entries[key]
+
+
+class SearchResult:
+    """Compact record holding only the fields of a Pixabay hit that the bot displays"""
+
+    __slots__ = ('media_id', 'media_kind', 'media_url', 'thumb_url', 'views', 'likes', 'downloads', 'tags',
+                 'name', 'artist', 'duration', 'genre')
+
+    # Pixabay rendition sent to Telegram for each media kind
+    MEDIA_SIZES = {'photo': 'webformat', 'video': 'small', 'audio': 'audio'}
+
+    def __init__(self, media_id: Optional[int] = None, media_kind: Optional[str] = None,
+                 media_url: Optional[str] = None, thumb_url: Optional[str] = None,
+                 views=None, likes=None, downloads=None, tags=None,
+                 name=None, artist=None, duration=None, genre=None):
+        self.media_id = media_id
+        self.media_kind = media_kind
+        self.media_url = media_url
+        self.thumb_url = thumb_url
+        self.views = views
+        self.likes = likes
+        self.downloads = downloads
+        self.tags = tags
+        self.name = name
+        self.artist = artist
+        self.duration = duration
+        self.genre = genre
+
+    @classmethod
+    def from_hit(cls, hit: Dict[str, Any]) -> 'SearchResult':
+        """Project a raw Pixabay hit into a compact record"""
+        media_kind = None
+        media_url = None
+        thumb_url = None
+        
+        # Check for different media types
+        if 'webformatURL' in hit:  # Images, illustrations, vectors
+            media_url = hit['webformatURL']
+            thumb_url = hit.get('previewURL', media_url)
+            media_kind = 'photo'
+        elif 'videos' in hit:  # Video results
+            media_url = hit['videos']['small']['url']
+            thumb_url = hit['videos']['small'].get('thumbnail')
+            media_kind = 'video'
+        elif 'url' in hit and hit.get('type') == 'music':  # Music
+            media_url = hit['url']
+            media_kind = 'audio'
+        
+        return cls(
+            media_id=hit.get('id'),
+            media_kind=media_kind,
+            media_url=media_url,
+            thumb_url=thumb_url,
+            views=hit.get('views'),
+            likes=hit.get('likes'),
+            downloads=hit.get('downloads'),
+            tags=hit.get('tags'),
+            name=hit.get('name'),
+            artist=hit.get('artist'),
+            duration=hit.get('duration'),
+            genre=hit.get('genre')
+        )
+
+    def media_key(self) -> Optional[Tuple[str, int, str]]:
+        """Identify the delivered media rendition, or None if it can't be cached"""
+        if self.media_id is None or self.media_kind is None:
+            return None
+        return self.media_kind, self.media_id, self.MEDIA_SIZES[self.media_kind]
+
+
+class FileIdCache:
+    """Bounded LRU map from Pixabay media to the Telegram file_id of its first delivery"""
+
+    def __init__(self, store: StateStore, max_entries: int = FILE_ID_CACHE_MAX_ENTRIES):
+        self.store = store
+        self.max_entries = max_entries
+        self.entries: OrderedDict = OrderedDict()  # (media_kind, media_id, size) -> file_id
+        self.hits = 0
+        self.misses = 0
+
+    async def load(self):
+        """Load persisted file_ids from the state store"""
+        for key, file_id in await self.store.load_file_ids(self.max_entries):
+            self.entries[key] = file_id
+
+    def get(self, result: 'SearchResult') -> Optional[str]:
+        """Return the cached file_id for a result, if any"""
+        key = result.media_key()
+        file_id = self.entries.get(key) if key else None
+        if file_id is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return file_id
+
+    def remember(self, result: 'SearchResult', message: Any):
+        """Record the file_id Telegram assigned to a sent or edited media message"""
+        key = result.media_key()
+        if key is None or not isinstance(message, Message):
+            return
+        if message.photo:
+            file_id = message.photo[-1].file_id
+        elif message.video:
+            file_id = message.video.file_id
+        elif message.audio:
+            file_id = message.audio.file_id
+        else:
+            return
+        if self.entries.get(key) == file_id:
+            return
+        
+        self.entries[key] = file_id
+        self.entries.move_to_end(key)
+        self.store.save_file_id(key, file_id)
+        while len(self.entries) > self.max_entries:
+            evicted, _ = self.entries.popitem(last=False)
+            self.store.delete_file_id(evicted)
+
+    def forget(self, result: 'SearchResult'):
+        """Drop a file_id Telegram no longer accepts"""
+        key = result.media_key()
+        if key in self.entries:
+            del self.entries[key]
+            self.store.delete_file_id(key)
+
+    def stats(self) -> Dict[str, Any]:
+        """Return cache counters"""
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self.entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / lookups if lookups else 0.0
+        }
+
+
+class MediaCache:
+    """Byte-bounded LRU cache of prefetched media files"""
+
+    def __init__(self, max_bytes: int = MEDIA_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.entries: OrderedDict = OrderedDict()  # media key -> bytes
+        self.total_bytes = 0
+
+    def __contains__(self, key) -> bool:
+        return key in self.entries
+
+    def get(self, result: 'SearchResult') -> Optional[bytes]:
+        """Return the prefetched bytes of a result, if any"""
+        key = result.media_key()
+        data = self.entries.get(key) if key else None
+        if data is not None:
+            self.entries.move_to_end(key)
+        return data
+
+    def put(self, key: Tuple[str, int, str], data: bytes):
+        """Store media bytes, evicting least recently used files past the limit"""
+        if key in self.entries or len(data) > self.max_bytes:
+            return
+        self.entries[key] = data
+        self.total_bytes += len(data)
+        while self.total_bytes > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.total_bytes -= len(evicted)
+
+    def discard(self, result: 'SearchResult'):
+        """Drop media bytes once Telegram holds the file"""
+        data = self.entries.pop(result.media_key(), None)
+        if data is not None:
+            self.total_bytes -= len(data)
+
+
+# Tashkeel (harakat, tanwin, shadda, sukun, Quranic marks) and tatweel are dropped;
+# hamza-carrying alefs and alef maqsura fold into their plain letters
+ARABIC_NORMALIZATION = {
+    **{code: None for code in range(0x064B, 0x0660)},
+    0x0670: None,
+    **{code: None for code in range(0x06D6, 0x06EE)},
+    0x0640: None,
+    **{ord(alef): 'ا' for alef in 'أإآٱ'},
+    ord('ى'): 'ي',
+    ord('ی'): 'ي',
+}
+
+
+def normalize_query(text: str) -> str:
+    """Return the canonical form of a search query, shared by all its spelling variants"""
+    return ' '.join(text.translate(ARABIC_NORMALIZATION).casefold().split())
+
+
+class QueryIndex:
+    """Sorted array of past normalized queries with frequencies, for prefix suggestions"""
+
+    def __init__(self, max_entries: int = QUERY_INDEX_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.queries: List[str] = []  # sorted
+        self.counts: Dict[str, int] = {}
+
+    def add(self, query: str):
+        """Count one successful search for a normalized query"""
+        if query in self.counts:
+            self.counts[query] += 1
+            return
+        self.counts[query] = 1
+        bisect.insort(self.queries, query)
+        if len(self.counts) > self.max_entries:
+            # Forget the least searched tenth in one pass
+            for rare in heapq.nsmallest(max(1, self.max_entries // 10), self.counts, key=self.counts.get):
+                del self.counts[rare]
+            self.queries = sorted(self.counts)
+
+    def suggest(self, prefix: str = '', limit: int = SUGGESTION_COUNT, exclude: str = '') -> List[str]:
+        """Return the most searched queries starting with prefix"""
+        start = bisect.bisect_left(self.queries, prefix)
+        end = bisect.bisect_left(self.queries, prefix + '\U0010ffff') if prefix else len(self.queries)
+        candidates = (query for query in itertools.islice(self.queries, start, end) if query != exclude)
+        return heapq.nlargest(limit, candidates, key=self.counts.get)
+
+    def did_you_mean(self, query: str, limit: int = SUGGESTION_COUNT) -> List[str]:
+        """Suggest past queries sharing the longest possible prefix with a query that found nothing"""
+        for length in range(len(query) - 1, 1, -1):
+            suggestions = self.suggest(query[:length], limit, exclude=query)
+            if suggestions:
+                return suggestions
+        return []
+
+
+class TrendingWarmer:
+    """Keeps the first result page of trending queries warm, refreshed by a background task
+
+    Demand is counted per (query, search_type) and decays every cycle. Each cycle the top
+    queries of every search type with at least TRENDING_MIN_COUNT demand whose warm page would
+    expire before the next cycle are taken from the response cache while it is still fresh there,
+    and otherwise re-fetched at background priority, within TRENDING_QUOTA_SHARE of the Pixabay quota.
+    """
+
+    def __init__(self, fetch: Callable[[str, str], Awaitable[Dict[str, Any]]], scheduler: QuotaScheduler,
+                 cached: Callable[[str, str], Optional[Tuple[float, Dict[str, Any]]]] = lambda query, search_type: None,
+                 interval: float = TRENDING_INTERVAL, top_n: int = TRENDING_TOP_N, ttl: float = TRENDING_WARM_TTL,
+                 quota_share: float = TRENDING_QUOTA_SHARE, min_count: float = TRENDING_MIN_COUNT):
+        self.fetch = fetch
+        self.cached = cached
+        self.min_count = min_count
+        self.scheduler = scheduler
+        self.interval = interval
+        self.top_n = top_n
+        self.ttl = ttl
+        self.quota_share = quota_share
+        self.counts: Dict[Tuple[str, str], float] = {}
+        self.warm: Dict[Tuple[str, str], Tuple[float, Dict[str, Any]]] = {}  # key -> (expires_at, page)
+        self.task: Optional[asyncio.Task] = None
+        self.demand = asyncio.Event()
+        self.hits = 0
+        self.misses = 0
+        self.refreshed = 0
+
+    def record(self, query: str, search_type: str):
+        """Count one search"""
+        key = (query, search_type)
+        self.counts[key] = self.counts.get(key, 0) + 1
+        self.demand.set()
+
+    def get(self, query: str, search_type: str) -> Optional[Dict[str, Any]]:
+        """Return the warm first page of a query, if any"""
+        entry = self.warm.get((query, search_type))
+        if entry is None or entry[0] < time.monotonic():
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry[1]
+
+    def trending(self) -> List[Tuple[str, str]]:
+        """Return the top queries of every search type with enough demand, most searched first"""
+        by_type: Dict[str, List[Tuple[float, str]]] = {}
+        for (query, search_type), count in self.counts.items():
+            if count < self.min_count:
+                continue
+            by_type.setdefault(search_type, []).append((count, query))
+        top = [(count, query, search_type) for search_type, items in by_type.items()
+               for count, query in heapq.nlargest(self.top_n, items)]
+        return [(query, search_type) for _, query, search_type in sorted(top, reverse=True)]
+
+    def budget(self) -> int:
+        """Pixabay calls one cycle may make"""
+        limit = self.scheduler.limit or 100
+        return max(1, int(limit * self.quota_share * self.interval / PIXABAY_DEFAULT_RESET))
+
+    async def refresh(self):
+        """Warm the trending queries that would go cold before the next cycle"""
+        now = time.monotonic()
+        self.warm = {key: entry for key, entry in self.warm.items() if entry[0] > now}
+        budget = self.budget()
+        for key in self.trending():
+            if budget <= 0:
+                break
+            entry = self.warm.get(key)
+            if entry is not None and entry[0] > now + self.interval:
+                continue
+            # The page a search just fetched is shared with the response cache instead of fetched again
+            cached = self.cached(*key)
+            if cached is not None and cached[0] > now + self.interval:
+                if cached[1].get('total', 0):
+                    self.warm[key] = cached
+                continue
+            # An 'all' refresh asks every source, each a Pixabay call of its own
+            cost = len(ALL_SEARCH_SOURCES) if key[1] == 'all' else 1
+            if cost > budget:
+                continue
+            budget -= cost
+            data = await self.fetch(*key)
+            if data.get('total', 0):
+                self.warm[key] = (time.monotonic() + self.ttl, data)
+                self.refreshed += 1
+        
+        # Old demand fades so the warm set follows what is trending now
+        self.counts = {key: count * TRENDING_DECAY for key, count in self.counts.items()
+                       if count * TRENDING_DECAY >= 0.1}
+
+    async def _run(self):
+        while True:
+            if not self.counts and not self.warm:
+                # Demand has faded out: stay asleep until the next search
+                self.demand.clear()
+                await self.demand.wait()
+            await asyncio.sleep(self.interval)
+            try:
+                await self.refresh()
+            except Exception as e:
+                logger.error(f"Trending pre-warm error: {e}")
+
+    def start(self):
+        """Start the background refresh task"""
+        if self.task is None:
+            self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stop the background refresh task"""
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    def stats(self) -> Dict[str, Any]:
+        """Return warm store counters"""
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self.warm),
+            'tracked': len(self.counts),
+            'hits': self.hits,
+            'misses': self.misses,
+            'refreshed': self.refreshed,
+            'hit_ratio': self.hits / lookups if lookups else 0.0
+        }
+
+
+def display_value(value: Any) -> Any:
+    """Return a result field for a caption, or the Arabic 'unspecified' placeholder"""
+    return 'غير محدد' if value is None else value
+
+
+def throttle_text(retry_after: float) -> str:
+    """Return the reply to a throttled user"""
+    return f"⏳ طلبات كثيرة، حاول مرة أخرى بعد {int(retry_after) + 1} ثانية"
+
 
-# Flask app for webhook
-app = Flask(__name__)
-application_instance = None
+def popularity_score(result: SearchResult) -> float:
+    """Rank results of different sources against each other: downloads and likes weigh more than views"""
+    return (result.views or 0) + 4 * (result.downloads or 0) + 20 * (result.likes or 0)
 
-# Validate essential configuration
-if not BOT_TOKEN:
-    logger.error("BOT_TOKEN is required!")
-    exit(1)
 
-if not PIXABAY_API_KEY:
-    logger.error("PIXABAY_API_KEY is required!")
-    exit(1)
+def merge_search_pages(pages: Dict[str, Any]) -> Dict[str, Any]:
+    """Merge one result page per source into a single page ordered by popularity
+
+    A source that failed (its page is an exception) is left out; if all failed, the first error is raised.
+    """
+    failed = {source: page for source, page in pages.items() if isinstance(page, BaseException)}
+    if pages and len(failed) == len(pages):
+        raise next(iter(failed.values()))
+    for source, error in failed.items():
+        logger.warning(f"Search source {source} failed, showing the others: {error}")
+    
+    answered = {source: page for source, page in pages.items() if source not in failed}
+    hits = [hit for page in answered.values() for hit in page['hits']]
+    return {
+        'total': sum(page.get('total', 0) for page in answered.values()),
+        'totalHits': sum(page.get('totalHits', 0) for page in answered.values()),
+        'hits': sorted(hits, key=popularity_score, reverse=True),
+        'sources': {source: page.get('totalHits', 0) for source, page in answered.items()}
+    }
+
+
+def notify_once(callback: Optional[Callable[[], Awaitable[Any]]]) -> Optional[Callable[[], Awaitable[Any]]]:
+    """Wrap an on_queued callback so concurrent requests notify the user a single time"""
+    if callback is None:
+        return None
+    notified = False
+    
+    async def notify():
+        nonlocal notified
+        if not notified:
+            notified = True
+            await callback()
+    return notify
+
+
+def parse_search_response(data: Dict[str, Any]) -> Dict[str, Any]:
+    """Keep the counters of a Pixabay response and project its hits into SearchResult records"""
+    return {
+        'total': data.get('total', 0),
+        'totalHits': data.get('totalHits', 0),
+        'hits': [SearchResult.from_hit(hit) for hit in data.get('hits', [])]
+    }
 
-# In-memory storage (for production, consider using a database)
-users_data = {}
-force_channels = []  # List of channel usernames
-banned_users = set()
-bot_stats = {
-    'total_users': 0,
-    'total_searches': 0,
-    'start_date': datetime.now().isoformat()
-}
 
 class PixabayBot:
     def __init__(self):
-        self.pixabay_base_url = "https://pixabay.com/api/"
+        self.pixabay_base_url = PIXABAY_API_URL
+        self.pixabay = PixabayClient()
+        self.store = create_state_store()
+        self.memberships = MembershipCache()
+        self.sessions = SessionStore()
+        self.query_index = QueryIndex()
+        self.trending = TrendingWarmer(self.fetch_fresh_first_page, self.pixabay.scheduler, self.cached_first_page)
+        self.flood = FloodControl()
+        self.broadcasts = BroadcastEngine(self.store)
+        self.file_ids = FileIdCache(self.store)
+        self.media_cache = MediaCache()
+        self.prefetch_tasks: Dict[int, asyncio.Task] = {}
+        # Navigation taps not rendered yet: user_id -> (net steps, latest callback query)
+        self.pending_moves: Dict[int, Tuple[int, Any]] = {}
+        self.move_tasks: Dict[int, asyncio.Task] = {}
+        # Set to render a user's pending move without waiting out NAV_DEBOUNCE
+        self.move_flushes: Dict[int, asyncio.Event] = {}
+        self.search_cache = ResponseCache()
+        self.page_loads: Dict[int, asyncio.Task] = {}
         self.search_types = {
             'photo': '📷 الصور',
             'illustration': '🎨 الرسوم التوضيحية', 
@@ -64,7 +1949,90 @@ class PixabayBot:
             'music': '🎵 الموسيقى',
             'gif': '🎞️ الصور المتحركة'
         }
+        self.register_metrics()
+    
+    def register_metrics(self):
+        """Expose cache, Pixabay and memory gauges; they are only computed when /metrics is scraped"""
+        def membership_hit_ratio() -> float:
+            lookups = self.memberships.hits + self.memberships.misses
+            return self.memberships.hits / lookups if lookups else 0.0
+        
+        metrics.register('bot_cache_hit_ratio', 'gauge', "Cache hit ratio", lambda: {
+            ('search',): self.search_cache.stats()['hit_ratio'],
+            ('file_id',): self.file_ids.stats()['hit_ratio'],
+            ('membership',): membership_hit_ratio()
+        }, ('cache',))
+        metrics.register('bot_cache_entries', 'gauge', "Entries held per cache", lambda: {
+            ('search',): len(self.search_cache.entries),
+            ('file_id',): len(self.file_ids.entries),
+            ('membership',): len(self.memberships.entries),
+            ('media',): len(self.media_cache.entries)
+        }, ('cache',))
+        metrics.register('bot_cache_bytes', 'gauge', "Bytes held per cache", lambda: {
+            ('search',): self.search_cache.total_bytes,
+            ('media',): self.media_cache.total_bytes
+        }, ('cache',))
+        metrics.register('bot_trending_warm_hit_ratio', 'gauge', "Searches answered from the trending warm store",
+                         lambda: self.trending.stats()['hit_ratio'])
+        metrics.register('bot_trending_warm_entries', 'gauge', "Warm trending first pages",
+                         lambda: len(self.trending.warm))
+        metrics.register('bot_users', 'gauge', "Users held in users_data", lambda: len(users_data))
+        metrics.register('bot_sessions', 'gauge', "Live search sessions", lambda: len(self.sessions.entries))
+        metrics.register('bot_sessions_dropped_total', 'counter', "Search sessions dropped", lambda: {
+            ('expired',): self.sessions.expired,
+            ('evicted',): self.sessions.evicted
+        }, ('reason',))
+        metrics.register('bot_stored_results', 'gauge', "Search results held across all sessions",
+                         self.sessions.stored_results)
+        metrics.register('bot_searches_total', 'counter', "Searches performed", lambda: bot_stats['total_searches'])
+        metrics.register('bot_throttled_total', 'counter', "Searches and navigation taps refused by flood control",
+                         lambda: {(action,): count for action, count in self.flood.throttled.items()}, ('action',))
+        metrics.register('bot_flood_buckets', 'gauge', "Per-user flood control buckets held",
+                         lambda: len(self.flood.buckets))
+        metrics.register('bot_pixabay_events_total', 'counter', "Pixabay client requests, retries, failures and hedges",
+                         lambda: {(event,): count for event, count in self.pixabay.metrics.items()}, ('event',))
+        metrics.register('bot_pixabay_breaker_open', 'gauge', "1 while the Pixabay circuit breaker is open",
+                         lambda: 1 if self.pixabay.breaker.state == CircuitBreaker.OPEN else 0)
+        metrics.register('bot_pixabay_quota_remaining', 'gauge', "Pixabay requests left in the rate-limit window",
+                         lambda: float('nan') if self.pixabay.scheduler.remaining is None else self.pixabay.scheduler.remaining)
     
+    def throttle(self, user_id: int, action: str) -> float:
+        """Return 0 if the user may perform the action now, else the seconds to wait; the admin is exempt"""
+        if user_id == ADMIN_ID:
+            return 0.0
+        return self.flood.check(user_id, action)
+    
+    async def post_init(self, application: Application):
+        """Open shared resources once the application is initialized"""
+        await self.store.open()
+        await self.file_ids.load()
+        await self.pixabay.open()
+        await self.broadcasts.resume(application.bot)
+        self.trending.start()
+    
+    async def post_shutdown(self, application: Application):
+        """Release shared resources when the application shuts down"""
+        # Renders the drain did not wait for (taps handled while stopping) finish while Pixabay is
+        # open, within what is left of the shutdown deadline
+        renders = list(self.move_tasks.values())
+        for flush in self.move_flushes.values():
+            flush.set()
+        if renders:
+            _, unfinished = await asyncio.wait(renders, timeout=shutdown_time_left())
+            stragglers = list(unfinished) + list(self.prefetch_tasks.values())
+        else:
+            stragglers = list(self.prefetch_tasks.values())
+        for task in stragglers:
+            task.cancel()
+        if stragglers:
+            # Let them unwind before the Pixabay client and the store they use are closed
+            await asyncio.wait(stragglers, timeout=SHUTDOWN_CANCEL_GRACE)
+        await self.trending.stop()
+        await self.broadcasts.stop()
+        await self.pixabay.close()
+        await self.store.close()
+    
+    @timed_handler
     async def start_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle /start command"""
         user_id = update.effective_user.id
@@ -77,17 +2045,14 @@ class PixabayBot:
         
         # Add user to database if not exists
         if user_id not in users_data:
-            users_data[user_id] = {
-                'username': username,
-                'join_date': datetime.now().isoformat(),
-                'search_count': 0,
-                'current_search': None,
-                'search_results': [],
-                'current_result_index': 0,
-                'selected_search_type': 'all',
-                'waiting_for_search': False
-            }
+            users_data[user_id] = new_user_record(username)
             bot_stats['total_users'] += 1
+            self.store.save_user(user_id, username, users_data[user_id]['join_date'])
+        elif not users_data[user_id]['active'] or worker_shard['count'] > 1:
+            # The user came back after blocking the bot. With several workers a broadcast
+            # from another worker may have pruned them without this copy knowing, so write through
+            users_data[user_id]['active'] = True
+            self.store.set_user_active(user_id, True)
         
         # Check force subscription
         if not await self.check_user_subscriptions(user_id, context):
@@ -97,22 +2062,57 @@ class PixabayBot:
         # User is subscribed, show main menu
         await self.send_main_menu(update)
     
-    async def check_user_subscriptions(self, user_id: int, context: ContextTypes.DEFAULT_TYPE) -> bool:
-        """Check if user is subscribed to all mandatory channels"""
+    async def check_user_subscriptions(self, user_id: int, context: ContextTypes.DEFAULT_TYPE,
+                                       refresh: bool = False) -> bool:
+        """Check if user is subscribed to all mandatory channels
+
+        Cached results are used where possible; the remaining channels are checked
+        concurrently. With refresh=True cached non-memberships are re-checked.
+        """
         if not force_channels:
             return True
         
+        unknown = []
         for channel in force_channels:
-            try:
-                member = await context.bot.get_chat_member(chat_id=channel, user_id=user_id)
-                if member.status in ['left', 'kicked']:
-                    return False
-            except Exception as e:
-                logger.error(f"Error checking subscription for {channel}: {e}")
-                # If we can't check, assume not subscribed
+            is_member = self.memberships.get(user_id, channel)
+            if is_member is None or (refresh and not is_member):
+                unknown.append(channel)
+            elif not is_member:
                 return False
         
-        return True
+        if not unknown:
+            return True
+        
+        results = await asyncio.gather(*[
+            self.check_channel_membership(user_id, channel, context) for channel in unknown
+        ])
+        return all(results)
+    
+    async def check_channel_membership(self, user_id: int, channel: str, context: ContextTypes.DEFAULT_TYPE) -> bool:
+        """Ask Telegram whether a user is a member of one channel"""
+        try:
+            member = await context.bot.get_chat_member(chat_id=channel, user_id=user_id)
+        except Exception as e:
+            logger.error(f"Error checking subscription for {channel}: {e}")
+            # If we can't check, assume not subscribed
+            return False
+        
+        is_member = member.status not in ['left', 'kicked']
+        self.memberships.set(user_id, channel, is_member)
+        return is_member
+    
+    async def handle_chat_member(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Keep the membership cache current from chat_member updates of force channels"""
+        chat_member = update.chat_member
+        if not chat_member.chat.username:
+            return
+        
+        channel = f"@{chat_member.chat.username}"
+        if channel.lower() not in [c.lower() for c in force_channels]:
+            return
+        
+        is_member = chat_member.new_chat_member.status not in ['left', 'kicked']
+        self.memberships.set(chat_member.new_chat_member.user.id, channel, is_member)
     
     async def send_subscription_message(self, update: Update):
         """Send subscription verification message"""
@@ -156,28 +2156,36 @@ class PixabayBot:
         else:
             await update.callback_query.edit_message_text(message, reply_markup=reply_markup)
     
+    @timed_handler
     async def handle_callback_query(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle inline keyboard callbacks"""
         query = update.callback_query
-        await query.answer()
-        
         user_id = query.from_user.id
         data = query.data
         
+        # A throttled tap only gets a toast: no message edit and no Pixabay call
+        action = FLOOD_CALLBACK_ACTIONS.get(data) or FLOOD_CALLBACK_ACTIONS.get(data.split('_', 1)[0] + '_')
+        retry_after = self.throttle(user_id, action) if action else 0.0
+        if retry_after:
+            await query.answer(throttle_text(retry_after))
+            return
+        await query.answer()
+        
         # Check if user is banned
         if user_id in banned_users:
             await query.edit_message_text("❌ تم حظرك من استخدام البوت")
             return
         
         if data == "verify_subscription":
-            if await self.check_user_subscriptions(user_id, context):
+            if await self.check_user_subscriptions(user_id, context, refresh=True):
                 await self.send_main_menu(update)
             else:
                 await query.edit_message_text("❌ لم تشترك في جميع القنوات المطلوبة!")
         
         elif data == "start_search":
-            await query.edit_message_text("🔍 ارسل كلمة البحث:")
-            users_data[user_id]['waiting_for_search'] = True
+            await query.edit_message_text("🔍 ارسل كلمة البحث:", reply_markup=self.build_suggestion_keyboard(
+                self.query_index.suggest(), "🔥"))
+            self.sessions.get_or_create(user_id)['waiting_for_search'] = True
         
         elif data == "search_type_menu":
             await self.show_search_type_menu(query, user_id)
@@ -188,18 +2196,35 @@ class PixabayBot:
             await self.show_search_type_menu(query, user_id)
         
         elif data == "search_with_type":
-            await query.edit_message_text("🔍 ارسل كلمة البحث:")
-            users_data[user_id]['waiting_for_search'] = True
+            await query.edit_message_text("🔍 ارسل كلمة البحث:", reply_markup=self.build_suggestion_keyboard(
+                self.query_index.suggest(), "🔥"))
+            self.sessions.get_or_create(user_id)['waiting_for_search'] = True
+        
+        elif data.startswith("suggest_"):
+            session = self.sessions.get(user_id)
+            if session is not None:
+                session['waiting_for_search'] = False
+            await self.perform_search(update, user_id, data.replace("suggest_", "", 1))
         
         elif data == "next_result":
-            await self.navigate_results(query, user_id, 1)
+            self.queue_move(query, user_id, 1, context.application)
         
         elif data == "prev_result":
-            await self.navigate_results(query, user_id, -1)
+            self.queue_move(query, user_id, -1, context.application)
         
         elif data == "select_result":
             await self.select_result(query, user_id)
         
+        elif data == "toggle_gallery":
+            users_data[user_id]['gallery_mode'] = not users_data[user_id].get('gallery_mode', False)
+            await self.show_search_type_menu(query, user_id)
+        
+        elif data == "next_album":
+            await self.navigate_album(query, user_id, 1)
+        
+        elif data == "prev_album":
+            await self.navigate_album(query, user_id, -1)
+        
         elif data == "back_to_main":
             await self.send_main_menu(update)
         
@@ -221,12 +2246,15 @@ class PixabayBot:
             indicator = "👻" if current_type == search_type else ""
             keyboard.append([InlineKeyboardButton(f"{display_name} {indicator}", callback_data=f"search_type_{search_type}")])
         
+        gallery_indicator = "✅" if users_data[user_id].get('gallery_mode') else "❌"
+        keyboard.append([InlineKeyboardButton(f"🖼️ وضع الألبوم ({ALBUM_SIZE} نتائج) {gallery_indicator}", callback_data="toggle_gallery")])
         keyboard.append([InlineKeyboardButton("بدء البحث عن النوع المحدد 🔍", callback_data="search_with_type")])
         keyboard.append([InlineKeyboardButton("🔙 العودة", callback_data="back_to_main")])
         
         reply_markup = InlineKeyboardMarkup(keyboard)
         await query.edit_message_text("اختر نوع البحث:", reply_markup=reply_markup)
     
+    @timed_handler
     async def handle_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle text messages"""
         user_id = update.effective_user.id
@@ -245,36 +2273,47 @@ class PixabayBot:
             await self.send_subscription_message(update)
             return
         
+        # The session, and with it what the bot was waiting for, expired: the text may be a search
+        session = self.sessions.get(user_id)
+        if session is None:
+            await self.send_session_expired(update.message)
+            return
+        
         # Handle search queries
-        if users_data[user_id].get('waiting_for_search'):
+        if session.get('waiting_for_search'):
+            retry_after = self.throttle(user_id, 'search')
+            if retry_after:
+                # Still waiting for a search: the user can send it again later
+                if self.flood.first_warning(user_id, 'search'):
+                    await update.message.reply_text(throttle_text(retry_after))
+                return
+            session['waiting_for_search'] = False
             await self.perform_search(update, user_id)
-            users_data[user_id]['waiting_for_search'] = False
         
         # Handle admin functions
         elif user_id == ADMIN_ID:
-            if users_data[user_id].get('waiting_for_broadcast'):
+            if session.get('waiting_for_broadcast'):
                 await self.send_broadcast_message(update, update.message.text)
-                users_data[user_id]['waiting_for_broadcast'] = False
-            elif users_data[user_id].get('waiting_for_channel_add'):
+                session['waiting_for_broadcast'] = False
+            elif session.get('waiting_for_channel_add'):
                 await self.add_channel(update, update.message.text)
-                users_data[user_id]['waiting_for_channel_add'] = False
-            elif users_data[user_id].get('waiting_for_channel_remove'):
+                session['waiting_for_channel_add'] = False
+            elif session.get('waiting_for_channel_remove'):
                 await self.remove_channel(update, update.message.text)
-                users_data[user_id]['waiting_for_channel_remove'] = False
-            elif users_data[user_id].get('waiting_for_user_action'):
+                session['waiting_for_channel_remove'] = False
+            elif session.get('waiting_for_user_action'):
                 await self.handle_user_action(update, update.message.text)
-                users_data[user_id]['waiting_for_user_action'] = False
+                session['waiting_for_user_action'] = False
     
-    async def perform_search(self, update: Update, user_id: int):
-        """Perform Pixabay search"""
-        search_query = update.message.text
-        search_type = users_data[user_id].get('selected_search_type', 'all')
-        
+    def build_search_request(self, search_query: str, search_type: str,
+                             page: int = 1) -> Tuple[str, Dict[str, Any]]:
+        """Build the Pixabay endpoint URL and parameters for one result page"""
         # Pixabay API parameters
         params = {
             'key': PIXABAY_API_KEY,
             'q': search_query,
-            'per_page': 100,  # Increased to 100 results
+            'per_page': SEARCH_PAGE_SIZE,
+            'page': page,
             'safesearch': 'true',
             'lang': 'ar'
         }
@@ -283,86 +2322,394 @@ class PixabayBot:
         if search_type != 'all' and search_type in self.search_types:
             if search_type == 'music':
                 # Music search uses different endpoint
-                url = "https://pixabay.com/api/music/"
+                url = f"{self.pixabay_base_url}music/"
             elif search_type == 'video':
-                url = "https://pixabay.com/api/videos/"
+                url = f"{self.pixabay_base_url}videos/"
             else:
                 params['category'] = search_type
                 url = self.pixabay_base_url
         else:
+            # 'image': every image category
             url = self.pixabay_base_url
         
+        return url, params
+    
+    async def fetch_search(self, search_query: str, search_type: str, page: int = 1,
+                           priority: int = PRIORITY_INTERACTIVE,
+                           on_queued: Optional[Callable[[], Awaitable[Any]]] = None) -> Dict[str, Any]:
+        """Fetch one page of a Pixabay search through the response cache"""
+        if search_type == 'all':
+            return await self.fetch_all(search_query, page, priority, on_queued)
+        url, params = self.build_search_request(search_query, search_type, page)
+        key = ResponseCache.make_key(search_query, search_type, params['lang'], params['safesearch'], url, page)
+        
+        async def fetch():
+            data, size = await self.pixabay.get_json(url, params, priority, on_queued)
+            return parse_search_response(data), size
+        
+        return await self.search_cache.get_or_fetch(key, fetch)
+    
+    def is_search_cached(self, search_query: str, search_type: str, page: int = 1) -> bool:
+        """Return True if a search page is cached or already being fetched, so it costs no Pixabay call"""
+        for source in (ALL_SEARCH_SOURCES if search_type == 'all' else (search_type,)):
+            url, params = self.build_search_request(search_query, source, page)
+            key = ResponseCache.make_key(search_query, source, params['lang'], params['safesearch'], url, page)
+            if key not in self.search_cache.inflight and self.search_cache.get(key) is None:
+                return False
+        return True
+    
+    async def fetch_all(self, search_query: str, page: int = 1, priority: int = PRIORITY_INTERACTIVE,
+                        on_queued: Optional[Callable[[], Awaitable[Any]]] = None,
+                        sources: Tuple[str, ...] = ALL_SEARCH_SOURCES) -> Dict[str, Any]:
+        """Fetch one page of every source concurrently and merge them by popularity"""
+        on_queued = notify_once(on_queued)
+        pages = await asyncio.gather(*(self.fetch_search(search_query, source, page, priority, on_queued)
+                                       for source in sources), return_exceptions=True)
+        return merge_search_pages(dict(zip(sources, pages)))
+    
+    async def fetch_all_first_page(self, search_query: str, on_queued: Optional[Callable[[], Awaitable[Any]]] = None
+                                   ) -> Tuple[Dict[str, Any], Dict[str, asyncio.Task]]:
+        """Start the first page of every source and return as soon as one of them has results
+
+        Returns the merged pages received so far and the tasks of the sources still loading.
+        """
+        on_queued = notify_once(on_queued)
+        tasks = {asyncio.create_task(self.fetch_search(search_query, source, 1, PRIORITY_INTERACTIVE, on_queued)): source
+                 for source in ALL_SEARCH_SOURCES}
+        pages: Dict[str, Any] = {}
+        pending = set(tasks)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                pages[tasks[task]] = task.exception() or task.result()
+            if any(isinstance(page, dict) and page['hits'] for page in pages.values()):
+                break
+        return merge_search_pages(pages), {tasks[task]: task for task in pending}
+    
+    async def _merge_late_sources(self, user_id: int, pending: Dict[str, asyncio.Task]) -> bool:
+        """Merge the sources that answered after the first result was shown into the unseen results"""
+        session = self.sessions.peek(user_id)
+        if session is None:
+            return False
+        results = session['search_results']
+        pages: Dict[str, Any] = {}
+        for source, task in pending.items():
+            try:
+                pages[source] = await task
+            except Exception as e:
+                logger.warning(f"Search source {source} failed after the first results: {e}")
+        
+        # Drop the pages if the user started another search or the session expired meanwhile
+        if not pages or self.sessions.peek(user_id) is not session or session['search_results'] is not results:
+            return False
+        late = merge_search_pages(pages)
+        
+        # The result on screen keeps its place; the ones after it are re-ranked with the newcomers
+        index = session['current_result_index']
+        results[index + 1:] = sorted(results[index + 1:] + late['hits'], key=popularity_score, reverse=True)
+        session['search_total'] += late['totalHits']
+        session['source_totals'].update(late['sources'])
+        return bool(late['hits'])
+    
+    def cached_first_page(self, search_query: str, search_type: str) -> Optional[Tuple[float, Dict[str, Any]]]:
+        """Return (expires_at, page) of a first result page still fresh in the response cache, if any"""
+        entries = {}
+        for source in (ALL_SEARCH_SOURCES if search_type == 'all' else (search_type,)):
+            url, params = self.build_search_request(search_query, source)
+            entry = self.search_cache.peek(ResponseCache.make_key(search_query, source, params['lang'],
+                                                                  params['safesearch'], url))
+            if entry is None:
+                return None
+            entries[source] = entry
+        if search_type != 'all':
+            return entries[search_type]
+        return (min(expires_at for expires_at, _ in entries.values()),
+                merge_search_pages({source: page for source, (_, page) in entries.items()}))
+    
+    async def fetch_fresh_first_page(self, search_query: str, search_type: str) -> Dict[str, Any]:
+        """Fetch the first result page from Pixabay at background priority, refreshing the response cache"""
+        if search_type == 'all':
+            pages = await asyncio.gather(*(self.fetch_fresh_first_page(search_query, source)
+                                           for source in ALL_SEARCH_SOURCES), return_exceptions=True)
+            return merge_search_pages(dict(zip(ALL_SEARCH_SOURCES, pages)))
+        url, params = self.build_search_request(search_query, search_type)
+        data, size = await self.pixabay.get_json(url, params, PRIORITY_BACKGROUND)
+        data = parse_search_response(data)
+        key = ResponseCache.make_key(search_query, search_type, params['lang'], params['safesearch'], url)
+        self.search_cache.put(key, data, size)
+        return data
+    
+    async def load_more_results(self, user_id: int, priority: int = PRIORITY_INTERACTIVE) -> bool:
+        """Load the next result page for a user, sharing one load per user"""
+        task = self.page_loads.get(user_id)
+        if task is None:
+            task = asyncio.create_task(self._load_next_page(user_id, priority))
+            self.page_loads[user_id] = task
+            task.add_done_callback(lambda t: self.page_loads.pop(user_id, None) if self.page_loads.get(user_id) is t else None)
+        try:
+            return await asyncio.shield(task)
+        except Exception as e:
+            logger.error(f"Error loading more results for {user_id}: {e}")
+            return False
+    
+    async def _load_next_page(self, user_id: int, priority: int) -> bool:
+        session = self.sessions.peek(user_id)
+        if session is None:
+            return False
+        results = session['search_results']
+        if len(results) >= session['search_total']:
+            return False
+        
+        search_query = session['current_search']
+        page = session['search_page'] + 1
+        if session['current_search_type'] == 'all':
+            # Only ask the sources that still have pages left
+            sources = tuple(source for source, hits in session['source_totals'].items()
+                            if (page - 1) * SEARCH_PAGE_SIZE < hits)
+            data = await self.fetch_all(search_query, page, priority, sources=sources)
+        else:
+            data = await self.fetch_search(search_query, session['current_search_type'], page, priority)
+        
+        # Drop the page if the user started another search or the session expired meanwhile
+        if self.sessions.peek(user_id) is not session or session['search_results'] is not results:
+            return False
+        
+        hits = data.get('hits', [])
+        if not hits:
+            # Pixabay has nothing more to give, stop paging here
+            session['search_total'] = len(results)
+            return False
+        
+        results.extend(hits)
+        session['search_page'] = page
+        return True
+    
+    def schedule_prefetch(self, user_id: int):
+        """Warm the results after the one the user is viewing, replacing any earlier prefetch"""
+        self.cancel_prefetch(user_id)
+        task = asyncio.create_task(self._prefetch(user_id))
+        self.prefetch_tasks[user_id] = task
+        task.add_done_callback(lambda t: self.prefetch_tasks.pop(user_id, None) if self.prefetch_tasks.get(user_id) is t else None)
+    
+    def cancel_prefetch(self, user_id: int):
+        """Stop warming results for a user"""
+        task = self.prefetch_tasks.pop(user_id, None)
+        if task is not None:
+            task.cancel()
+    
+    async def _prefetch(self, user_id: int):
+        try:
+            # Give up if the user goes idle before the work is done
+            await asyncio.wait_for(self._warm_next_results(user_id), timeout=PREFETCH_IDLE_TIMEOUT)
+        except asyncio.TimeoutError:
+            pass
+        except Exception as e:
+            logger.error(f"Prefetch error for {user_id}: {e}")
+    
+    async def _warm_next_results(self, user_id: int):
+        session = self.sessions.peek(user_id)
+        if session is None:
+            return
+        
+        # Load the next page in the background when the user nears the end
+        loaded = len(session['search_results'])
+        if loaded < session['search_total'] and session['current_result_index'] >= loaded - SEARCH_PREFETCH_MARGIN:
+            await self.load_more_results(user_id, PRIORITY_BACKGROUND)
+        
+        # Fetch the media of the next results so Telegram gets bytes instead of a cold URL
+        results = session['search_results']
+        start = session['current_result_index'] + 1
+        for result in results[start:start + PREFETCH_AHEAD]:
+            key = result.media_key()
+            if key is None or result.media_kind == 'audio' or key in self.file_ids.entries or key in self.media_cache:
+                continue
+            data = await self.pixabay.get_bytes(result.media_url, PREFETCH_MAX_MEDIA_BYTES)
+            if data is not None:
+                self.media_cache.put(key, data)
+    
+    def build_suggestion_keyboard(self, queries: List[str], icon: str) -> Optional[InlineKeyboardMarkup]:
+        """Build one button per suggested query, skipping those too long for callback data"""
+        keyboard = [
+            [InlineKeyboardButton(f"{icon} {suggestion}", callback_data=f"suggest_{suggestion}")]
+            for suggestion in queries if len(f"suggest_{suggestion}".encode()) <= 64
+        ]
+        return InlineKeyboardMarkup(keyboard) if keyboard else None
+    
+    def queue_move(self, query, user_id: int, direction: int, application: Application):
+        """Add a navigation tap to the user's pending move, rendered once NAV_DEBOUNCE has passed
+
+        The render runs as an Application task, so a shutdown drain waits for it.
+        """
+        steps, _ = self.pending_moves.get(user_id, (0, None))
+        self.pending_moves[user_id] = (steps + direction, query)
+        task = self.move_tasks.get(user_id)
+        if task is None or task.done():
+            self.move_flushes[user_id] = asyncio.Event()
+            task = application.create_task(self._render_moves(user_id), name=f"render_moves:{user_id}")
+            self.move_tasks[user_id] = task
+            task.add_done_callback(lambda t: self._forget_moves(user_id, t))
+    
+    def _forget_moves(self, user_id: int, task: asyncio.Task):
+        if self.move_tasks.get(user_id) is task:
+            del self.move_tasks[user_id]
+            self.move_flushes.pop(user_id, None)
+    
+    async def flush_moves(self, user_id: int):
+        """Render the user's pending navigation now, so the next action sees the result on screen"""
+        task = self.move_tasks.get(user_id)
+        if task is None or task.done():
+            return
+        self.move_flushes[user_id].set()
+        # asyncio.wait leaves the render running even if the caller is cancelled
+        await asyncio.wait({task})
+    
+    async def cancel_moves(self, user_id: int):
+        """Drop the user's pending navigation, as when a new search replaces the results"""
+        self.pending_moves.pop(user_id, None)
+        task = self.move_tasks.get(user_id)
+        if task is not None and not task.done():
+            task.cancel()
+            # Wait for it to unwind so no edit of the old results lands after the new search
+            await asyncio.wait({task})
+    
+    async def _render_moves(self, user_id: int):
+        # Taps made while an edit is in flight are rendered by the next round
+        flush = self.move_flushes[user_id]
+        while user_id in self.pending_moves:
+            try:
+                await asyncio.wait_for(flush.wait(), timeout=NAV_DEBOUNCE)
+            except asyncio.TimeoutError:
+                pass
+            steps, query = self.pending_moves.pop(user_id)
+            try:
+                await self.navigate_results(query, user_id, steps)
+            except Exception as e:
+                logger.error(f"Error navigating results for {user_id}: {e}")
+    
+    @timed_handler
+    async def perform_search(self, update: Update, user_id: int, search_query: Optional[str] = None):
+        """Perform Pixabay search for the user's message (or a tapped suggestion)"""
+        message = update.effective_message
+        # Equivalent spellings share one canonical query, one cache entry and one Pixabay call
+        search_query = normalize_query(search_query if search_query is not None else message.text)
+        search_type = users_data[user_id].get('selected_search_type', 'all')
+        
+        # Results of the previous search are no longer worth warming or paging through
+        self.cancel_prefetch(user_id)
+        await self.cancel_moves(user_id)
+        # A load still running for the old results drops its page itself; paging must not wait on it
+        self.page_loads.pop(user_id, None)
+        
+        async def notify_queued():
+            await message.reply_text("⏳ طلبات البحث كثيرة الآن، طلبك في قائمة الانتظار وسيتم تنفيذه قريباً")
+        
         try:
-            response = requests.get(url, params=params, timeout=10)
-            data = response.json()
+            # Trending queries are answered from the warm store without waiting on Pixabay
+            data = self.trending.get(search_query, search_type) if search_query else {}
+            late_sources = {}
+            if data is None and search_type == 'all':
+                # Show the first result as soon as either source answers; the other is merged in later
+                data, late_sources = await self.fetch_all_first_page(search_query, on_queued=notify_queued)
+            elif data is None:
+                data = await self.fetch_search(search_query, search_type, on_queued=notify_queued)
             
             if data.get('total', 0) == 0:
-                await update.message.reply_text("""   ¯\\_(ツ)_/¯
-    كلماتك غريبة يا غلام""")
+                await message.reply_text("""   ¯\\_(ツ)_/¯
+    كلماتك غريبة يا غلام""", reply_markup=self.build_suggestion_keyboard(
+                    self.query_index.did_you_mean(search_query), "💡"))
                 return
             
-            # Store search results
-            users_data[user_id]['search_results'] = data['hits']
-            users_data[user_id]['current_result_index'] = 0
-            users_data[user_id]['current_search'] = search_query
+            self.query_index.add(search_query)
+            self.trending.record(search_query, search_type)
+            self.start_session(self.sessions.get_or_create(user_id), search_query, search_type, data)
+            users_data[user_id]['last_search'] = {'query': search_query, 'type': search_type, 'index': 0}
+            if late_sources:
+                # Registered as the user's page load, so paging waits for these results first
+                task = asyncio.create_task(self._merge_late_sources(user_id, late_sources))
+                self.page_loads[user_id] = task
+                task.add_done_callback(lambda t: self.page_loads.pop(user_id, None) if self.page_loads.get(user_id) is t else None)
             
             # Update statistics
             users_data[user_id]['search_count'] += 1
             bot_stats['total_searches'] += 1
+            self.store.increment_search_count(user_id)
             
-            # Show first result
-            await self.show_search_result(update, user_id)
+            # Show first result (or first album)
+            if users_data[user_id].get('gallery_mode'):
+                await self.show_album(message, user_id)
+            else:
+                await self.show_search_result(update, user_id)
             
+        except PixabayUnavailable:
+            await message.reply_text("⚠️ خدمة Pixabay لا تستجيب حالياً، حاول مرة أخرى بعد قليل")
         except Exception as e:
             logger.error(f"Search error: {e}")
-            await update.message.reply_text("❌ حدث خطأ في البحث، حاول مرة أخرى")
+            await message.reply_text("❌ حدث خطأ في البحث، حاول مرة أخرى")
     
-    async def show_search_result(self, update: Update, user_id: int, edit_message=False):
-        """Display search result with navigation"""
-        results = users_data[user_id]['search_results']
-        index = users_data[user_id]['current_result_index']
-        
-        if not results or index >= len(results):
-            return
-        
-        result = results[index]
-        
-        # Determine media type and prepare message
-        media_url = None
-        media_type = None
-        
-        # Check for different media types
-        if 'webformatURL' in result:  # Images, illustrations, vectors
-            media_url = result['webformatURL']
-            media_type = 'photo'
-        elif 'videos' in result:  # Video results
-            media_url = result['videos']['small']['url']
-            media_type = 'video'
-        elif 'url' in result and result.get('type') == 'music':  # Music
-            media_url = result['url']
-            media_type = 'audio'
-        
-        # Prepare caption based on media type
-        caption = f"🔍 النتيجة {index + 1} من {len(results)}\n"
-        
-        if media_type in ['photo', 'video']:
-            caption += f"👀 المشاهدات: {result.get('views', 'غير محدد')}\n"
-            caption += f"👍 الإعجابات: {result.get('likes', 'غير محدد')}\n"
-            caption += f"📥 التحميلات: {result.get('downloads', 'غير محدد')}\n"
-            caption += f"🏷️ الكلمات المفتاحية: {result.get('tags', 'غير محدد')}"
-        elif media_type == 'audio':
-            caption += f"🎵 {result.get('name', 'غير محدد')}\n"
-            caption += f"🎤 الفنان: {result.get('artist', 'غير محدد')}\n"
-            caption += f"⏱️ المدة: {result.get('duration', 'غير محدد')} ثانية\n"
-            caption += f"🏷️ النوع: {result.get('genre', 'غير محدد')}"
-        
-        # Navigation keyboard
+    def start_session(self, session: Dict[str, Any], search_query: str, search_type: str, data: Dict[str, Any]):
+        """Store the first page of results; later pages are loaded while navigating"""
+        session['search_results'] = list(data['hits'])
+        session['search_total'] = data.get('totalHits', len(data['hits']))
+        session['search_page'] = 1
+        # Hits of each source of an 'all' search, so paging skips the exhausted ones
+        session['source_totals'] = dict(data.get('sources', {}))
+        session['current_search_type'] = search_type
+        session['current_result_index'] = 0
+        session['current_search'] = search_query
+    
+    async def resume_session(self, user_id: int) -> Optional[Dict[str, Any]]:
+        """Return the user's search session, re-running the last search if the session expired"""
+        session = self.sessions.get(user_id)
+        if session is not None and session['search_results']:
+            return session
+        
+        # The profile may be gone too, as with the memory backend after a restart
+        last_search = users_data.get(user_id, {}).get('last_search')
+        if not last_search:
+            return None
+        data = await self.fetch_search(last_search['query'], last_search['type'])
+        if not data.get('hits'):
+            return None
+        
+        session = self.sessions.get_or_create(user_id)
+        self.start_session(session, last_search['query'], last_search['type'], data)
+        # Reload the pages up to where the user was
+        while last_search['index'] >= len(session['search_results']) and await self.load_more_results(user_id):
+            pass
+        session['current_result_index'] = min(last_search['index'], len(session['search_results']) - 1)
+        logger.info(f"Resumed expired search session of {user_id} at result {session['current_result_index']}")
+        return session
+    
+    async def send_session_expired(self, message: Message):
+        """Tell a user whose search can't be resumed to search again"""
+        reply_markup = InlineKeyboardMarkup([[InlineKeyboardButton("🔍 بحث جديد", callback_data="start_search")]])
+        await message.reply_text("⌛ انتهت جلسة البحث، ابدأ بحثاً جديداً", reply_markup=reply_markup)
+    
+    def build_result_caption(self, result: SearchResult, index: Optional[int], total: int) -> str:
+        """Build the caption for a search result (without the position line if index is None)"""
+        caption = f"🔍 النتيجة {index + 1} من {total}\n" if index is not None else ""
+        
+        if result.media_kind in ['photo', 'video']:
+            caption += f"👀 المشاهدات: {display_value(result.views)}\n"
+            caption += f"👍 الإعجابات: {display_value(result.likes)}\n"
+            caption += f"📥 التحميلات: {display_value(result.downloads)}\n"
+            caption += f"🏷️ الكلمات المفتاحية: {display_value(result.tags)}"
+        elif result.media_kind == 'audio':
+            caption += f"🎵 {display_value(result.name)}\n"
+            caption += f"🎤 الفنان: {display_value(result.artist)}\n"
+            caption += f"⏱️ المدة: {display_value(result.duration)} ثانية\n"
+            caption += f"🏷️ النوع: {display_value(result.genre)}"
+        
+        return caption
+    
+    def build_result_keyboard(self, index: int, total: int) -> InlineKeyboardMarkup:
+        """Build the navigation keyboard for a search result"""
         keyboard = []
         nav_row = []
         
         if index > 0:
             nav_row.append(InlineKeyboardButton("« السابق", callback_data="prev_result"))
-        if index < len(results) - 1:
+        if index < total - 1:
             nav_row.append(InlineKeyboardButton("التالي »", callback_data="next_result"))
         
         if nav_row:
@@ -370,156 +2717,370 @@ class PixabayBot:
         
         keyboard.append([InlineKeyboardButton("اختيار 🥇", callback_data="select_result")])
         
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        return InlineKeyboardMarkup(keyboard)
+    
+    async def show_search_result(self, update: Update, user_id: int, edit_message=False):
+        """Display search result with navigation"""
+        session = self.sessions.get_or_create(user_id)
+        results = session['search_results']
+        index = session['current_result_index']
+        total = session['search_total']
+        
+        if not results or index >= len(results):
+            return
+        
+        result = results[index]
+        # Reuse the file_id of an earlier delivery so Telegram doesn't refetch the URL
+        file_id = self.file_ids.get(result)
+        media_url = file_id or result.media_url
+        media_type = result.media_kind
+        
+        caption = self.build_result_caption(result, index, total)
+        reply_markup = self.build_result_keyboard(index, total)
         
         try:
             if media_type == 'photo':
-                await update.message.reply_photo(
+                message = await update.effective_message.reply_photo(
                     photo=media_url,
                     caption=caption,
                     reply_markup=reply_markup
                 )
             elif media_type == 'video':
-                await update.message.reply_video(
+                message = await update.effective_message.reply_video(
                     video=media_url,
                     caption=caption,
                     reply_markup=reply_markup
                 )
             elif media_type == 'audio':
-                await update.message.reply_audio(
+                message = await update.effective_message.reply_audio(
                     audio=media_url,
                     caption=caption,
                     reply_markup=reply_markup
                 )
             else:
-                await update.message.reply_text(caption, reply_markup=reply_markup)
+                message = await update.effective_message.reply_text(caption, reply_markup=reply_markup)
+            self.file_ids.remember(result, message)
                 
         except Exception as e:
             logger.error(f"Error showing result: {e}")
+            if file_id:
+                self.file_ids.forget(result)
             # Fallback to text message
-            await update.message.reply_text(caption, reply_markup=reply_markup)
+            await update.effective_message.reply_text(caption, reply_markup=reply_markup)
+        
+        self.schedule_prefetch(user_id)
     
-    async def navigate_results(self, query, user_id: int, direction: int):
-        """Navigate through search results"""
-        current_index = users_data[user_id]['current_result_index']
-        results = users_data[user_id]['search_results']
+    async def navigate_results(self, query, user_id: int, steps: int):
+        """Move steps results forward (or back, if negative) and edit the result message once"""
+        session = await self.resume_session(user_id)
+        if session is None:
+            await self.send_session_expired(query.message)
+            return
+        current_index = session['current_result_index']
+        results = session['search_results']
+        
+        new_index = current_index + steps
         
-        new_index = current_index + direction
+        # Load Pixabay pages until the target is loaded or there is nothing more
+        while new_index >= len(results) and await self.load_more_results(user_id):
+            results = session['search_results']
+        total = session['search_total']
+        # Taps past either end stop at the first or last result
+        new_index = max(0, min(new_index, len(results) - 1))
         
-        if 0 <= new_index < len(results):
-            users_data[user_id]['current_result_index'] = new_index
+        if results:
+            session['current_result_index'] = new_index
+            users_data[user_id]['last_search']['index'] = new_index
             
             result = results[new_index]
+            file_id = self.file_ids.get(result)
+            # Prefer the Telegram file_id, then prefetched bytes, then the Pixabay URL
+            media_source = file_id or self.media_cache.get(result) or result.media_url
+            media_url = result.media_url
+            media_type = result.media_kind
             
-            # Determine media type and prepare message
-            media_url = None
-            media_type = None
-            
-            if 'webformatURL' in result:  # Images, illustrations, vectors
-                media_url = result['webformatURL']
-                media_type = 'photo'
-            elif 'videos' in result:  # Video results
-                media_url = result['videos']['small']['url']
-                media_type = 'video'
-            elif 'url' in result and result.get('type') == 'music':  # Music
-                media_url = result['url']
-                media_type = 'audio'
-            
-            # Prepare caption
-            caption = f"🔍 النتيجة {new_index + 1} من {len(results)}\n"
+            caption = self.build_result_caption(result, new_index, total)
+            reply_markup = self.build_result_keyboard(new_index, total)
             
-            if media_type in ['photo', 'video']:
-                caption += f"👀 المشاهدات: {result.get('views', 'غير محدد')}\n"
-                caption += f"👍 الإعجابات: {result.get('likes', 'غير محدد')}\n"
-                caption += f"📥 التحميلات: {result.get('downloads', 'غير محدد')}\n"
-                caption += f"🏷️ الكلمات المفتاحية: {result.get('tags', 'غير محدد')}"
-            elif media_type == 'audio':
-                caption += f"🎵 {result.get('name', 'غير محدد')}\n"
-                caption += f"🎤 الفنان: {result.get('artist', 'غير محدد')}\n"
-                caption += f"⏱️ المدة: {result.get('duration', 'غير محدد')} ثانية\n"
-                caption += f"🏷️ النوع: {result.get('genre', 'غير محدد')}"
-            
-            # Navigation keyboard
-            keyboard = []
-            nav_row = []
-            
-            if new_index > 0:
-                nav_row.append(InlineKeyboardButton("« السابق", callback_data="prev_result"))
-            if new_index < len(results) - 1:
-                nav_row.append(InlineKeyboardButton("التالي »", callback_data="next_result"))
-            
-            if nav_row:
-                keyboard.append(nav_row)
-            
-            keyboard.append([InlineKeyboardButton("اختيار 🥇", callback_data="select_result")])
-            
-            reply_markup = InlineKeyboardMarkup(keyboard)
+            # Taps that cancel out leave the message as it is: skip the edit Telegram would refuse
+            if new_index == current_index and (query.message.caption or query.message.text) == caption:
+                return
             
             try:
                 if media_type == 'photo':
-                    media = InputMediaPhoto(media=media_url, caption=caption)
-                    await query.edit_message_media(media=media, reply_markup=reply_markup)
+                    media = InputMediaPhoto(media=media_source, caption=caption)
+                    message = await query.edit_message_media(media=media, reply_markup=reply_markup)
+                    self.file_ids.remember(result, message)
+                    self.media_cache.discard(result)
                 elif media_type == 'video':
-                    media = InputMediaVideo(media=media_url, caption=caption)
-                    await query.edit_message_media(media=media, reply_markup=reply_markup)
+                    media = InputMediaVideo(media=media_source, caption=caption)
+                    message = await query.edit_message_media(media=media, reply_markup=reply_markup)
+                    self.file_ids.remember(result, message)
+                    self.media_cache.discard(result)
                 else:
                     await query.edit_message_text(text=caption, reply_markup=reply_markup)
             except Exception as e:
+                if isinstance(e, BadRequest) and "not modified" in str(e).lower():
+                    # The message already shows this result
+                    return
                 logger.error(f"Error updating result: {e}")
+                if file_id:
+                    self.file_ids.forget(result)
                 # Send new message as fallback
                 try:
                     if media_type == 'photo':
-                        await query.message.reply_photo(
+                        message = await query.message.reply_photo(
                             photo=media_url,
                             caption=caption,
                             reply_markup=reply_markup
                         )
+                        self.file_ids.remember(result, message)
                     elif media_type == 'video':
-                        await query.message.reply_video(
+                        message = await query.message.reply_video(
                             video=media_url,
                             caption=caption,
                             reply_markup=reply_markup
                         )
+                        self.file_ids.remember(result, message)
                     else:
                         await query.message.reply_text(caption, reply_markup=reply_markup)
                 except Exception as e2:
                     logger.error(f"Fallback also failed: {e2}")
+            
+            self.schedule_prefetch(user_id)
+    
+    def build_album_keyboard(self, start: int, total: int) -> Optional[InlineKeyboardMarkup]:
+        """Build the page navigation keyboard sent after an album"""
+        nav_row = []
+        if start > 0:
+            nav_row.append(InlineKeyboardButton("« السابق", callback_data="prev_album"))
+        if start + ALBUM_SIZE < total:
+            nav_row.append(InlineKeyboardButton("التالي »", callback_data="next_album"))
+        return InlineKeyboardMarkup([nav_row]) if nav_row else None
+    
+    def build_album_media(self, results: List[SearchResult], start: int, total: int,
+                          use_file_ids: bool = True) -> List[Any]:
+        """Build the media group for a slice of results"""
+        media_types = {'photo': InputMediaPhoto, 'video': InputMediaVideo, 'audio': InputMediaAudio}
+        media = []
+        for offset, result in enumerate(results):
+            media_type = media_types[result.media_kind]
+            source = (self.file_ids.get(result) if use_file_ids else None) or result.media_url
+            media.append(media_type(media=source, caption=self.build_result_caption(result, start + offset, total)))
+        return media
+    
+    async def send_album_media(self, message: Message, results: List[SearchResult], start: int, total: int,
+                               use_file_ids: bool = True) -> List[Message]:
+        """Send a slice of results as a media group, or as a single media message when only one is left"""
+        media = self.build_album_media(results, start, total, use_file_ids)
+        if len(media) > 1:
+            return list(await message.reply_media_group(media))
+        # Telegram rejects media groups of fewer than two items
+        senders = {'photo': message.reply_photo, 'video': message.reply_video, 'audio': message.reply_audio}
+        return [await senders[results[0].media_kind](media[0].media, caption=media[0].caption)]
+    
+    async def show_album(self, message: Message, user_id: int):
+        """Send the results of the current page as one media group, followed by the page navigation"""
+        session = self.sessions.get_or_create(user_id)
+        start = session['current_result_index']
+        # Make sure the whole album is loaded
+        while start + ALBUM_SIZE > len(session['search_results']) and await self.load_more_results(user_id):
+            pass
+        results = [result for result in session['search_results'][start:start + ALBUM_SIZE]
+                   if result.media_kind is not None]
+        total = session['search_total']
+        if not results:
+            return
+        
+        try:
+            sent = await self.send_album_media(message, results, start, total)
+        except Exception as e:
+            logger.error(f"Error sending album: {e}")
+            sent = None
+            cached = [result for result in results if result.media_key() in self.file_ids.entries]
+            if cached:
+                # A stale file_id fails the whole group: forget them and retry with the Pixabay URLs
+                for result in cached:
+                    self.file_ids.forget(result)
+                try:
+                    sent = await self.send_album_media(message, results, start, total, use_file_ids=False)
+                except Exception as e2:
+                    logger.error(f"Album fallback also failed: {e2}")
+            if sent is None:
+                # Keep the page navigation so the user can retry or move on
+                await message.reply_text("❌ تعذر إرسال الألبوم، حاول مرة أخرى",
+                                         reply_markup=self.build_album_keyboard(start, total))
+                return
+        
+        for result, sent_message in zip(results, sent):
+            self.file_ids.remember(result, sent_message)
+        
+        end = min(start + ALBUM_SIZE, len(session['search_results']))
+        await message.reply_text(f"🖼️ النتائج {start + 1} - {end} من {total}",
+                                 reply_markup=self.build_album_keyboard(start, total))
+    
+    async def navigate_album(self, query, user_id: int, direction: int):
+        """Show the previous or next album"""
+        await self.flush_moves(user_id)
+        session = await self.resume_session(user_id)
+        if session is None:
+            await self.send_session_expired(query.message)
+            return
+        
+        new_start = session['current_result_index'] + direction * ALBUM_SIZE
+        if new_start >= len(session['search_results']):
+            await self.load_more_results(user_id)
+        if not 0 <= new_start < len(session['search_results']):
+            return
+        
+        session['current_result_index'] = new_start
+        users_data[user_id]['last_search']['index'] = new_start
+        # Only the newest navigation message keeps its buttons
+        try:
+            await query.edit_message_reply_markup(reply_markup=None)
+        except BadRequest as e:
+            logger.warning(f"Could not clear album navigation: {e}")
+        await self.show_album(query.message, user_id)
     
     async def select_result(self, query, user_id: int):
         """Handle result selection"""
-        results = users_data[user_id]['search_results']
-        index = users_data[user_id]['current_result_index']
+        await self.flush_moves(user_id)
+        session = await self.resume_session(user_id)
+        if session is None:
+            await self.send_session_expired(query.message)
+            return
+        results = session['search_results']
+        index = session['current_result_index']
         
         if results and index < len(results):
             result = results[index]
             
             # Remove keyboard and show selected result
-            if 'webformatURL' in result:
+            if result.media_kind == 'photo':
                 caption = f"✅ تم اختيار النتيجة\n"
-                caption += f"👀 المشاهدات: {result.get('views', 'غير محدد')}\n"
-                caption += f"👍 الإعجابات: {result.get('likes', 'غير محدد')}\n"
-                caption += f"📥 التحميلات: {result.get('downloads', 'غير محدد')}"
+                caption += f"👀 المشاهدات: {display_value(result.views)}\n"
+                caption += f"👍 الإعجابات: {display_value(result.likes)}\n"
+                caption += f"📥 التحميلات: {display_value(result.downloads)}"
                 
                 await query.edit_message_caption(caption=caption)
             else:
                 caption = f"✅ تم اختيار النتيجة\n"
-                caption += f"🎵 {result.get('name', 'غير محدد')}\n"
-                caption += f"🎤 الفنان: {result.get('artist', 'غير محدد')}\n"
-                caption += f"⏱️ المدة: {result.get('duration', 'غير محدد')} ثانية"
+                caption += f"🎵 {display_value(result.name)}\n"
+                caption += f"🎤 الفنان: {display_value(result.artist)}\n"
+                caption += f"⏱️ المدة: {display_value(result.duration)} ثانية"
                 
                 await query.edit_message_text(caption)
     
+    def build_inline_result(self, result: SearchResult, caption: str):
+        """Build the inline query answer entry for a search result"""
+        result_id = f"{result.media_kind}_{result.media_id}"
+        if result.media_kind == 'photo':
+            return InlineQueryResultPhoto(
+                id=result_id,
+                photo_url=result.media_url,
+                thumbnail_url=result.thumb_url,
+                caption=caption
+            )
+        if result.media_kind == 'video' and result.thumb_url:
+            return InlineQueryResultVideo(
+                id=result_id,
+                video_url=result.media_url,
+                mime_type='video/mp4',
+                thumbnail_url=result.thumb_url,
+                title=display_value(result.tags),
+                caption=caption
+            )
+        if result.media_kind == 'audio':
+            return InlineQueryResultAudio(
+                id=result_id,
+                audio_url=result.media_url,
+                title=display_value(result.name),
+                performer=result.artist,
+                caption=caption
+            )
+        return None
+    
+    async def handle_inline_query(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Answer inline searches (@bot query) page by page using next_offset"""
+        inline_query = update.inline_query
+        user_id = inline_query.from_user.id
+        search_query = normalize_query(inline_query.query)
+        
+        if user_id in banned_users or not search_query:
+            await inline_query.answer([], cache_time=INLINE_CACHE_TIME, is_personal=True)
+            return
+        
+        if not await self.check_user_subscriptions(user_id, context):
+            button = InlineQueryResultsButton(text="📢 اشترك في القنوات اولا", start_parameter="subscribe")
+            await inline_query.answer([], button=button, cache_time=0, is_personal=True)
+            return
+        
+        user = users_data.get(user_id)
+        search_type = user.get('selected_search_type', 'all') if user else 'all'
+        try:
+            page = max(int(inline_query.offset or 1), 1)
+        except ValueError:
+            page = 1
+        
+        # Every keystroke is a query of its own: a new one that would reach Pixabay takes from the user's
+        # search bucket. Scroll pages are never refused, since an empty answer ends Telegram's pagination
+        if not inline_query.offset and not self.is_search_cached(search_query, search_type):
+            retry_after = self.throttle(user_id, 'search')
+            if retry_after:
+                button = InlineQueryResultsButton(text=throttle_text(retry_after), start_parameter="throttled")
+                await inline_query.answer([], button=button, cache_time=0, is_personal=True)
+                return
+        
+        try:
+            # Pages come from the response cache, so repeated inline queries are answered from memory
+            data = await self.fetch_search(search_query, search_type, page)
+        except Exception as e:
+            logger.error(f"Inline search error: {e}")
+            await inline_query.answer([], cache_time=0, is_personal=True)
+            return
+        
+        total = data.get('totalHits', 0)
+        results = []
+        for result in data['hits']:
+            entry = self.build_inline_result(result, self.build_result_caption(result, None, total))
+            if entry is not None:
+                results.append(entry)
+        
+        has_more = data['hits'] and page * SEARCH_PAGE_SIZE < total
+        await inline_query.answer(
+            results,
+            next_offset=str(page + 1) if has_more else "",
+            cache_time=INLINE_CACHE_TIME,
+            is_personal=True
+        )
+    
+    async def handle_chosen_inline_result(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Count an inline search once the user sends one of its results
+        
+        Telegram only reports chosen results when inline feedback is enabled in BotFather (/setinlinefeedback).
+        """
+        user_id = update.chosen_inline_result.from_user.id
+        bot_stats['total_searches'] += 1
+        user = users_data.get(user_id)
+        if user:
+            user['search_count'] += 1
+            self.store.increment_search_count(user_id)
+    
     async def show_admin_panel_buttons(self, query):
         """Show admin control panel with buttons"""
         message = """🔧 لوحة تحكم المدير
         
 اختر العملية المطلوبة:"""
         
+        if self.broadcasts.is_running():
+            message += f"\n\n📡 {self.broadcasts.progress_text()}"
+        
         keyboard = [
             [InlineKeyboardButton("📊 الإحصائيات", callback_data="admin_stats")],
             [InlineKeyboardButton("📢 إدارة القنوات", callback_data="admin_channels")],
             [InlineKeyboardButton("👤 إدارة المستخدمين", callback_data="admin_users")],
             [InlineKeyboardButton("📡 إرسال إشعار", callback_data="admin_broadcast")],
+            [InlineKeyboardButton("📈 حالة الإشعار", callback_data="admin_broadcast_status")],
             [InlineKeyboardButton("🔙 العودة", callback_data="back_to_main")]
         ]
         
@@ -536,25 +3097,34 @@ class PixabayBot:
             await self.show_users_management(query)
         elif data == "admin_broadcast":
             await self.show_broadcast_menu(query)
+        elif data == "admin_broadcast_status":
+            await self.show_broadcast_status(query)
         elif data == "admin_add_channel":
             await query.edit_message_text("📢 أرسل اسم القناة مع @ (مثال: @channelname)")
-            users_data[query.from_user.id]['waiting_for_channel_add'] = True
+            self.sessions.get_or_create(query.from_user.id)['waiting_for_channel_add'] = True
         elif data == "admin_remove_channel":
             await query.edit_message_text("📢 أرسل اسم القناة مع @ المراد إزالتها")
-            users_data[query.from_user.id]['waiting_for_channel_remove'] = True
+            self.sessions.get_or_create(query.from_user.id)['waiting_for_channel_remove'] = True
         elif data.startswith("ban_user_"):
             user_id_to_ban = int(data.replace("ban_user_", ""))
             banned_users.add(user_id_to_ban)
+            self.store.set_banned(user_id_to_ban, True)
             await query.edit_message_text(f"✅ تم حظر المستخدم {user_id_to_ban}")
         elif data.startswith("unban_user_"):
             user_id_to_unban = int(data.replace("unban_user_", ""))
             banned_users.discard(user_id_to_unban)
+            self.store.set_banned(user_id_to_unban, False)
             await query.edit_message_text(f"✅ تم إلغاء حظر المستخدم {user_id_to_unban}")
     
     async def show_bot_stats_buttons(self, query):
         """Show bot statistics"""
         start_date = datetime.fromisoformat(bot_stats['start_date'])
         days_running = (datetime.now() - start_date).days
+        cache_stats = self.search_cache.stats()
+        file_id_stats = self.file_ids.stats()
+        trending_stats = self.trending.stats()
+        quota_stats = self.pixabay.scheduler.stats()
+        client_stats = self.pixabay.stats()
         
         message = f"""📊 إحصائيات البوت
 
@@ -564,6 +3134,11 @@ class PixabayBot:
 🚫 المستخدمون المحظورون: {len(banned_users)}
 📅 أيام تشغيل البوت: {days_running}
 🕐 تاريخ بدء البوت: {start_date.strftime('%Y-%m-%d %H:%M')}
+🗂️ ذاكرة البحث: {cache_stats['hits']} إصابة / {cache_stats['misses']} إخفاق ({cache_stats['hit_ratio']:.0%})
+📉 رصيد Pixabay: {display_value(quota_stats['remaining'])} / {display_value(quota_stats['limit'])} (في الانتظار: {quota_stats['queued']})
+🛡️ حالة Pixabay: {client_stats['breaker_state']} (إعادة محاولة: {client_stats['retries']}، فشل: {client_stats['failures']}، نتائج قديمة: {cache_stats['stale_served']})
+📎 ذاكرة الوسائط: {file_id_stats['entries']} ملف، {file_id_stats['hits']} إصابة / {file_id_stats['misses']} إخفاق ({file_id_stats['hit_ratio']:.0%})
+🔥 البحث الرائج: {trending_stats['entries']} جاهز، {trending_stats['hits']} إصابة / {trending_stats['misses']} إخفاق ({trending_stats['hit_ratio']:.0%})
 
 القنوات المطلوبة للاشتراك:
 {chr(10).join(force_channels) if force_channels else 'لا توجد قنوات'}"""
@@ -617,24 +3192,37 @@ class PixabayBot:
         await query.edit_message_text(message, reply_markup=reply_markup)
         
         # Set user state to wait for broadcast message
-        users_data[query.from_user.id]['waiting_for_broadcast'] = True
+        self.sessions.get_or_create(query.from_user.id)['waiting_for_broadcast'] = True
     
     async def send_broadcast_message(self, update: Update, message: str):
-        """Broadcast message to all users"""
-        sent_count = 0
-        failed_count = 0
+        """Start broadcasting a message to all users in the background"""
+        if self.broadcasts.is_running():
+            await update.message.reply_text("❌ يوجد إشعار جاري بالفعل، انتظر حتى ينتهي")
+            return
         
-        for user_id in users_data.keys():
-            if user_id != update.effective_user.id:  # Don't send to admin
-                try:
-                    await update.get_bot().send_message(chat_id=user_id, text=message)
-                    sent_count += 1
-                    await asyncio.sleep(0.1)  # Rate limiting
-                except Exception as e:
-                    logger.error(f"Failed to send broadcast to {user_id}: {e}")
-                    failed_count += 1
+        job = await self.broadcasts.start(update.get_bot(), message, update.effective_user.id)
+        
+        keyboard = [[InlineKeyboardButton("🔄 تحديث الحالة", callback_data="admin_broadcast_status")]]
+        reply_markup = InlineKeyboardMarkup(keyboard)
+        await update.message.reply_text(f"📡 بدأ إرسال الإشعار إلى {job['total']} مستخدم في الخلفية", reply_markup=reply_markup)
+    
+    async def show_broadcast_status(self, query):
+        """Show live progress of the current broadcast"""
+        message = f"""📡 حالة الإشعار
+
+{self.broadcasts.progress_text()}"""
         
-        await update.message.reply_text(f"✅ تم إرسال الرسالة إلى {sent_count} مستخدم\n❌ فشل الإرسال إلى {failed_count} مستخدم")
+        keyboard = [
+            [InlineKeyboardButton("🔄 تحديث الحالة", callback_data="admin_broadcast_status")],
+            [InlineKeyboardButton("🔙 العودة للوحة التحكم", callback_data="admin_panel")]
+        ]
+        reply_markup = InlineKeyboardMarkup(keyboard)
+        try:
+            await query.edit_message_text(message, reply_markup=reply_markup)
+        except BadRequest as e:
+            # Refresh pressed without any progress since the last update
+            if 'not modified' not in str(e).lower():
+                raise
     
     async def add_channel(self, update: Update, channel: str):
         """Add channel to force subscription list"""
@@ -643,6 +3231,7 @@ class PixabayBot:
         
         if channel not in force_channels:
             force_channels.append(channel)
+            self.store.save_channels(force_channels)
             await update.message.reply_text(f"✅ تم إضافة القناة {channel} للاشتراك الإجباري")
         else:
             await update.message.reply_text(f"❌ القناة {channel} موجودة بالفعل")
@@ -654,6 +3243,8 @@ class PixabayBot:
         
         if channel in force_channels:
             force_channels.remove(channel)
+            self.store.save_channels(force_channels)
+            self.memberships.forget_channel(channel)
             await update.message.reply_text(f"✅ تم إزالة القناة {channel} من الاشتراك الإجباري")
         else:
             await update.message.reply_text(f"❌ القناة {channel} غير موجودة في قائمة الاشتراك الإجباري")
@@ -664,36 +3255,360 @@ class PixabayBot:
             user_id = int(user_input)
             if user_id in banned_users:
                 banned_users.discard(user_id)
+                self.store.set_banned(user_id, False)
                 await update.message.reply_text(f"✅ تم إلغاء حظر المستخدم {user_id}")
             else:
                 banned_users.add(user_id)
+                self.store.set_banned(user_id, True)
                 await update.message.reply_text(f"✅ تم حظر المستخدم {user_id}")
         except ValueError:
             await update.message.reply_text("❌ معرف المستخدم غير صحيح")
 
 
-@app.route('/')
-def index():
-    return "Pixabay Telegram Bot is running!"
+# aiohttp app for webhook, served on the same event loop as the Application
+routes = web.RouteTableDef()
+APPLICATION_KEY = web.AppKey('application', Application)
+WORKER_QUEUES_KEY = web.AppKey('worker_queues', list)
+
+
+@routes.get('/')
+async def index(request: web.Request):
+    return web.Response(text="Pixabay Telegram Bot is running!")
+
+@routes.get('/health')
+async def health(request: web.Request):
+    return web.Response(text="OK")
+
+@routes.get('/metrics')
+async def metrics_endpoint(request: web.Request):
+    return web.Response(text=metrics.render(), headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+@routes.post(f'/{BOT_TOKEN}')
+async def webhook(request: web.Request):
+    application = request.app[APPLICATION_KEY]
+    try:
+        json_data = await request.json()
+    except ValueError:
+        return web.Response(status=400, text="Bad Request")
+    
+    update = Update.de_json(json_data, application.bot)
+    worker_queues = request.app.get(WORKER_QUEUES_KEY)
+    try:
+        if worker_queues:
+            # All updates of a user go to the same worker, which keeps them in order
+            worker_queues[shard_for_user(update_user_id(update), len(worker_queues))].put_nowait(json_data)
+        elif update_backlog(application) < UPDATE_QUEUE_SIZE:
+            application.update_queue.put_nowait(update)
+        else:
+            raise asyncio.QueueFull
+    except (asyncio.QueueFull, queue.Full):
+        # Backpressure: Telegram redelivers the update later
+        logger.warning(f"Update queue is full ({UPDATE_QUEUE_SIZE}), rejecting update {update.update_id}")
+        return web.Response(status=429, text="Too Many Requests",
+                            headers={'Retry-After': str(WEBHOOK_RETRY_AFTER)})
+    return web.Response(text="OK")
+
+def update_user_id(update: Update) -> int:
+    """Return the user id an update is routed by"""
+    if update.chat_member:
+        # The member whose status changed, not the admin who changed it
+        return update.chat_member.new_chat_member.user.id
+    if update.effective_user:
+        return update.effective_user.id
+    return update.effective_chat.id if update.effective_chat else 0
+
+def update_backlog(application: Application) -> int:
+    """Updates accepted but not handled yet: still queued or held by the update processor"""
+    return application.update_queue.qsize() + application.update_processor.pending_total
+
+
+class UserOrderedUpdateProcessor(BaseUpdateProcessor):
+    """Runs updates of different users concurrently and each user's updates one at a time, in order
+
+    Session state and the admin waiting_for_* flags assume a user's updates never overlap. A user
+    with max_pending updates already waiting has further updates dropped.
+    """
+
+    def __init__(self, max_concurrent_updates: int = UPDATE_CONCURRENCY,
+                 max_pending: int = USER_MAX_PENDING_UPDATES):
+        super().__init__(max_concurrent_updates)
+        self.max_pending = max_pending
+        self.locks: Dict[int, asyncio.Lock] = {}
+        self.pending: Dict[int, int] = {}
+        self.pending_total = 0
+        self.dropped = 0
+        self.discarding = False
+        self.finished = asyncio.Event()
+        self.tasks: set = set()
+
+    async def process_update(self, update: object, coroutine: Awaitable[Any]):
+        # The Application starts one task per update in arrival order, and asyncio.Lock wakes
+        # waiters first-in first-out, so a user's updates keep their order
+        user_id = update_user_id(update) if isinstance(update, Update) else 0
+        pending = self.pending.get(user_id, 0)
+        if pending >= self.max_pending:
+            coroutine.close()
+            self.dropped += 1
+            logger.warning(f"User {user_id} has {pending} updates pending, dropping update")
+            return
+        
+        self.pending[user_id] = pending + 1
+        self.pending_total += 1
+        lock = self.locks.setdefault(user_id, asyncio.Lock())
+        task = asyncio.current_task()
+        self.tasks.add(task)
+        try:
+            # Waiting for the user's turn does not take one of the shared slots
+            async with lock:
+                await super().process_update(update, coroutine)
+        finally:
+            self.tasks.discard(task)
+            self.pending_total -= 1
+            self.pending[user_id] -= 1
+            if not self.pending[user_id]:
+                del self.pending[user_id]
+                del self.locks[user_id]
+            self.finished.set()
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]):
+        if self.discarding:
+            coroutine.close()
+            self.dropped += 1
+            return
+        await coroutine
+
+    def discard_pending(self):
+        """Drop every update that has not started yet, as when the shutdown deadline passes"""
+        self.discarding = True
+
+    def cancel_running(self):
+        """Cancel the handlers still running or waiting for their user's turn"""
+        for task in self.tasks:
+            task.cancel()
+
+    async def wait_for_room(self, limit: int):
+        """Wait until fewer than limit updates are pending"""
+        while self.pending_total >= limit:
+            self.finished.clear()
+            await self.finished.wait()
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+def create_web_app(application: Application, worker_queues: Optional[list] = None) -> web.Application:
+    """Create the aiohttp app serving the webhook and health endpoints
 
-@app.route('/health')
-def health():
-    return "OK"
+    With worker_queues, updates are routed to worker processes instead of the local application.
+    """
+    web_app = web.Application()
+    web_app[APPLICATION_KEY] = application
+    web_app.add_routes(routes)
+    if worker_queues:
+        web_app[WORKER_QUEUES_KEY] = worker_queues
+        metrics.register('bot_worker_queue_depth', 'gauge', "Updates waiting for each worker process", lambda: {
+            (str(index),): updates.qsize() for index, updates in enumerate(worker_queues)
+        }, ('worker',))
+    else:
+        metrics.register('bot_update_queue_depth', 'gauge', "Updates waiting in the update queue",
+                         application.update_queue.qsize)
+        metrics.register('bot_updates_pending', 'gauge', "Updates running or waiting for their user's turn",
+                         lambda: application.update_processor.pending_total)
+        metrics.register('bot_updates_dropped_total', 'counter', "Updates dropped because a user had too many pending",
+                         lambda: application.update_processor.dropped)
+    return web_app
 
-@app.route(f'/{BOT_TOKEN}', methods=['POST'])
-def webhook():
-    if application_instance:
-        json_data = request.get_json()
-        update = Update.de_json(json_data, application_instance.bot)
-        asyncio.create_task(application_instance.process_update(update))
-    return "OK"
+def begin_shutdown() -> float:
+    """Start the shutdown clock, if not started yet, and return its deadline"""
+    if shutdown_state['deadline'] is None:
+        shutdown_state['deadline'] = time.monotonic() + DRAIN_TIMEOUT
+    return shutdown_state['deadline']
 
-def run_flask():
-    app.run(host='0.0.0.0', port=PORT, debug=False)
+def shutdown_time_left() -> float:
+    """Seconds left before the shutdown deadline"""
+    return max(0.0, begin_shutdown() - time.monotonic())
+
+def install_stop_handlers() -> asyncio.Event:
+    """Return an event set on SIGTERM (sent by Render on deploys and idle sleep) or SIGINT"""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    
+    def on_signal():
+        # Render's grace period counts from the signal, so the deadline does too
+        begin_shutdown()
+        stop.set()
+    
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, on_signal)
+    return stop
+
+async def sync_webhook(bot: Bot, webhook_url: str):
+    """Register the webhook unless Telegram already has it, as after every wake from idle sleep"""
+    info = await bot.get_webhook_info()
+    if info.url == webhook_url and set(info.allowed_updates or ()) == set(Update.ALL_TYPES):
+        logger.info("Webhook already set, skipping registration")
+        return
+    # chat_member updates are not sent unless explicitly requested
+    await bot.set_webhook(webhook_url, allowed_updates=Update.ALL_TYPES)
+    logger.info(f"Webhook set to: {webhook_url}")
+
+async def drain_application(application: Application):
+    """Stop the Application, giving queued and in-flight updates until the shutdown deadline to finish"""
+    pending = update_backlog(application)
+    stopping = asyncio.create_task(application.stop())
+    done, _ = await asyncio.wait({stopping}, timeout=shutdown_time_left())
+    if done:
+        logger.info(f"Drained {pending} pending updates")
+        return
+    
+    # Out of time: updates that have not started are dropped and running handlers are cancelled,
+    # so none of them writes to the store after it is closed
+    logger.warning(f"Drain deadline of {DRAIN_TIMEOUT}s passed with {update_backlog(application)} updates "
+                   f"pending, dropping those not started and cancelling the rest")
+    application.update_processor.discard_pending()
+    application.update_processor.cancel_running()
+    await asyncio.wait({stopping}, timeout=SHUTDOWN_CANCEL_GRACE)
+
+async def run_webhook(application: Application, webhook_url: str):
+    """Run the Application and the webhook server on one event loop until SIGTERM or SIGINT"""
+    started = time.monotonic()
+    stop = install_stop_handlers()
+    
+    # Open the port first: updates received before the Application starts wait in its queue
+    runner = web.AppRunner(create_web_app(application))
+    await runner.setup()
+    await web.TCPSite(runner, '0.0.0.0', PORT).start()
+    logger.info(f"Webhook server listening on port {PORT}")
+    
+    try:
+        # getMe and the webhook check are independent round trips
+        await asyncio.gather(application.initialize(), sync_webhook(application.bot, webhook_url))
+        if application.post_init:
+            await application.post_init(application)
+        await application.start()
+        logger.info(f"Bot ready in {time.monotonic() - started:.2f}s")
+        
+        await stop.wait()
+        logger.info("Stop signal received, draining updates...")
+    finally:
+        # Stop accepting updates, then let the accepted ones finish
+        await runner.cleanup()
+        if application.running:
+            await drain_application(application)
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+        await application.shutdown()
+
+async def run_receiver(application: Application, webhook_url: str):
+    """Serve the webhook and route updates to WORKERS worker processes by user_id"""
+    started = time.monotonic()
+    stop = install_stop_handlers()
+    context = multiprocessing.get_context('spawn')
+    worker_queues = [context.Queue(maxsize=UPDATE_QUEUE_SIZE) for _ in range(WORKERS)]
+    workers = [
+        context.Process(target=worker_main, args=(index, WORKERS, worker_queues[index]), name=f"worker-{index}")
+        for index in range(WORKERS)
+    ]
+    for worker in workers:
+        worker.start()
+    
+    runner = web.AppRunner(create_web_app(application, worker_queues))
+    await runner.setup()
+    await web.TCPSite(runner, '0.0.0.0', PORT).start()
+    logger.info(f"Webhook receiver listening on port {PORT} with {WORKERS} workers")
+    
+    try:
+        await asyncio.gather(application.initialize(), sync_webhook(application.bot, webhook_url))
+        logger.info(f"Receiver ready in {time.monotonic() - started:.2f}s")
+        
+        await stop.wait()
+        logger.info("Stop signal received, draining workers...")
+    finally:
+        await runner.cleanup()
+        # Workers finish the updates already routed to them, then exit; a few extra
+        # seconds let them flush their stores after their own drain deadline
+        loop = asyncio.get_running_loop()
+        deadline = time.monotonic() + DRAIN_TIMEOUT + 5
+        for updates in worker_queues:
+            try:
+                await loop.run_in_executor(None, updates.put, None, True, max(0.0, deadline - time.monotonic()))
+            except queue.Full:
+                pass
+        for worker in workers:
+            await loop.run_in_executor(None, worker.join, max(0.0, deadline - time.monotonic()))
+            if worker.is_alive():
+                logger.warning(f"{worker.name} did not stop in time, killing it")
+                worker.kill()
+        await application.shutdown()
+
+def worker_main(index: int, count: int, updates):
+    """Entry point of a worker process serving the users of one shard"""
+    # The receiver stops workers through their queue
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    worker_shard['index'] = index
+    worker_shard['count'] = count
+    asyncio.run(run_worker(build_application(PixabayBot()), updates))
+
+async def run_worker(application: Application, updates):
+    """Feed the updates routed to this worker into its Application until the receiver stops it"""
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    await application.start()
+    logger.info(f"Worker {worker_shard['index']} of {worker_shard['count']} started")
+    
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            json_data = await loop.run_in_executor(None, updates.get)
+            if json_data is None:
+                break
+            # Leave updates in the shared queue while this worker is saturated
+            await application.update_processor.wait_for_room(UPDATE_QUEUE_SIZE)
+            await application.update_queue.put(Update.de_json(json_data, application.bot))
+    finally:
+        if application.running:
+            await drain_application(application)
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+        await application.shutdown()
+        logger.info(f"Worker {worker_shard['index']} stopped")
+
+def build_application(bot: PixabayBot, token: str = BOT_TOKEN, base_url: Optional[str] = None,
+                      update_processor: Optional[UserOrderedUpdateProcessor] = None) -> Application:
+    """Create the Application running the bot's handlers
+
+    base_url and update_processor let the benchmark point the bot at a Telegram stand-in and observe updates.
+    """
+    builder = (
+        Application.builder()
+        .token(token)
+        .post_init(bot.post_init)
+        .post_shutdown(bot.post_shutdown)
+        .update_queue(asyncio.Queue(maxsize=UPDATE_QUEUE_SIZE))
+        .concurrent_updates(update_processor or UserOrderedUpdateProcessor())
+        .request(InstrumentedRequest(connection_pool_size=256))
+    )
+    if base_url:
+        builder = builder.base_url(base_url)
+    application = builder.build()
+    add_handlers(application, bot)
+    return application
+
+def add_handlers(application: Application, bot: PixabayBot):
+    """Register the bot's update handlers"""
+    application.add_handler(CommandHandler("start", bot.start_command))
+    application.add_handler(CallbackQueryHandler(bot.handle_callback_query))
+    application.add_handler(ChatMemberHandler(bot.handle_chat_member, ChatMemberHandler.CHAT_MEMBER))
+    application.add_handler(InlineQueryHandler(bot.handle_inline_query))
+    application.add_handler(ChosenInlineResultHandler(bot.handle_chosen_inline_result))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, bot.handle_message))
 
 def main():
     """Start the bot"""
-    global application_instance
     try:
         # Validate bot token
         if not BOT_TOKEN or BOT_TOKEN == 'YOUR_BOT_TOKEN_HERE':
@@ -704,21 +3619,9 @@ def main():
             logger.error("Pixabay API key is not set properly!")
             return
         
-        # Create bot instance
-        bot = PixabayBot()
-        
-        # Create application with proper settings
-        application = (
-            Application.builder()
-            .token(BOT_TOKEN)
-            .build()
-        )
-        application_instance = application
-        
-        # Add handlers
-        application.add_handler(CommandHandler("start", bot.start_command))
-        application.add_handler(CallbackQueryHandler(bot.handle_callback_query))
-        application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, bot.handle_message))
+        if WORKERS > 1 and STORAGE_BACKEND != 'sqlite':
+            logger.error("WORKERS > 1 requires STORAGE_BACKEND=sqlite so the workers share state")
+            return
         
         # Start the bot
         logger.info("Starting Pixabay Telegram Bot...")
@@ -730,33 +3633,24 @@ def main():
         # Always use webhook mode - no polling
         logger.info("Starting in webhook mode...")
         
-        # Start Flask in background thread
-        flask_thread = threading.Thread(target=run_flask, daemon=True)
-        flask_thread.start()
-        
         # Set webhook URL
         if WEBHOOK_URL:
             webhook_url = f"{WEBHOOK_URL}/{BOT_TOKEN}"
+        elif RENDER_EXTERNAL_URL:
+            webhook_url = f"{RENDER_EXTERNAL_URL}/{BOT_TOKEN}"
         else:
             webhook_url = f"https://{os.getenv('REPL_SLUG', 'telegram-bot')}.{os.getenv('REPL_OWNER', 'user')}.repl.co/{BOT_TOKEN}"
         
-        # Set webhook
-        application.bot.set_webhook(webhook_url)
-        logger.info(f"Webhook set to: {webhook_url}")
-        
-        # Keep application running
-        application.initialize()
-        application.start()
-        
-        # Keep main thread alive
         try:
-            while True:
-                asyncio.sleep(1)
+            if WORKERS > 1:
+                # This process only receives updates; the bot runs in the workers
+                application = Application.builder().token(BOT_TOKEN).build()
+                asyncio.run(run_receiver(application, webhook_url))
+            else:
+                # Run the application and webhook server on one event loop
+                asyncio.run(run_webhook(build_application(PixabayBot()), webhook_url))
         except KeyboardInterrupt:
             logger.info("Shutting down...")
-        finally:
-            application.stop()
-            application.shutdown()
         
     except Exception as e:
         logger.error(f"Failed to start bot: {e}")